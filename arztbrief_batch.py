@@ -0,0 +1,325 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+
+from arztbrief_report import check_report_quality, create_pdf_report, insert_icds_into_diagnosis
+from icd_catalog import load_icd_catalog
+from letter_generation import SYSTEM_PROMPT, build_messages, generate_letter
+from letter_pipeline import STAGES, LetterJob, LetterPipeline
+from metrics import current_trace
+from openai_client import LLM_BASE_URL, get_openai_client, make_async_client
+from transcription_backends import OpenAIWhisperBackend, get_transcription_backend
+from transcription_cache import TranscriptionCache
+
+AUDIO_SUFFIXES = {".mp3", ".wav", ".m4a", ".webm", ".ogg", ".flac", ".mp4"}
+MANIFEST_NAME = "manifest.json"
+
+
+def find_recordings(input_dir):
+    return sorted(p for p in Path(input_dir).iterdir() if p.is_file() and p.suffix.lower() in AUDIO_SUFFIXES)
+
+
+def read_manifest(out_dir):
+    path = out_dir / MANIFEST_NAME
+    if not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def write_atomic(path, data):
+    # Erst vollständig in eine Temp-Datei, dann umbenennen: ein Abbruch hinterlässt nie eine halbe
+    # Datei, die beim Fortsetzen als fertiges Zwischenergebnis gelten würde
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    if isinstance(data, str):
+        tmp_path.write_text(data, encoding="utf-8")
+    else:
+        tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def write_manifest(out_dir, manifest):
+    write_atomic(out_dir / MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=2))
+
+
+def recording_dir(output_dir, audio_path):
+    # Voller Dateiname statt Stamm: a.mp3 und a.wav dürfen sich keinen Ordner (und kein Transkript) teilen
+    return Path(output_dir) / Path(audio_path).name
+
+
+class BatchRunner:
+    """Transkription → GPT-Arztbrief → ICD-Ergänzung → PDF für jede Aufnahme eines Ordners.
+
+    Jede Aufnahme bekommt einen eigenen Ausgabeordner mit Zwischenergebnissen und
+    `manifest.json`. Abgeschlossene Aufnahmen werden beim nächsten Lauf übersprungen,
+    abgebrochene setzen beim ersten fehlenden Zwischenergebnis wieder ein.
+    """
+
+    def __init__(self, client, icd_map, output_dir, system_prompt=SYSTEM_PROMPT, model="gpt-4o",
+                 temperature=0.3, logo_path=None, transcription_cache=None, language="de",
+                 transcription_backend=None):
+        self.client = client
+        self.icd_map = icd_map
+        self.output_dir = Path(output_dir)
+        self.system_prompt = system_prompt
+        self.model = model
+        self.temperature = temperature
+        self.logo_path = logo_path
+        self.transcription_cache = transcription_cache
+        self.language = language
+        self.transcription_backend = transcription_backend or get_transcription_backend(client, language=language)
+
+    def process(self, audio_path):
+        # Messwerte (z. B. im ARZTBRIEF_METRICS_JSONL-Log) der Aufnahme zuordnen
+        token = current_trace.set(audio_path.name)
+        try:
+            return self._process(audio_path)
+        finally:
+            current_trace.reset(token)
+
+    def _process(self, audio_path):
+        out_dir = recording_dir(self.output_dir, audio_path)
+        manifest = {"source": str(audio_path), "timings": {}}
+        start = time.perf_counter()
+        try:
+            # Auch ein nicht anlegbarer Ordner oder ein Schreibfehler im Manifest betrifft nur diese Aufnahme
+            manifest = self._start(out_dir, audio_path)
+            if manifest.get("status") == "done":
+                return manifest
+
+            transcript = self._stage(out_dir, manifest, "transcription", "transkript.txt",
+                                     lambda: self._transcribe(audio_path))
+            letter = self._stage(out_dir, manifest, "generation", "arztbrief_roh.txt",
+                                 lambda: self._generate(transcript, manifest))
+            letter_with_icd = self._stage(out_dir, manifest, "icd", "arztbrief.txt",
+                                          lambda: insert_icds_into_diagnosis(letter, self.icd_map))
+            manifest["quality_checks"] = check_report_quality(letter_with_icd)
+
+            pdf_path = out_dir / "arztbrief.pdf"
+            stage_start = time.perf_counter()
+            write_atomic(pdf_path, create_pdf_report(letter_with_icd, logo_path=self.logo_path).getvalue())
+            manifest["timings"]["pdf"] = time.perf_counter() - stage_start
+
+            manifest["status"] = "done"
+        except Exception as e:
+            manifest["status"] = "failed"
+            manifest["error"] = f"{type(e).__name__}: {e}"
+        manifest["timings"]["total_this_run"] = time.perf_counter() - start
+        manifest["finished_at"] = datetime.now(timezone.utc).isoformat()
+        try:
+            write_manifest(out_dir, manifest)
+        except OSError as e:
+            # Der ursprüngliche Fehler ist aussagekräftiger als der Folgefehler beim Schreiben
+            manifest["status"] = "failed"
+            manifest.setdefault("error", f"{type(e).__name__}: {e}")
+        return manifest
+
+    def _start(self, out_dir, audio_path):
+        """Manifest einer Aufnahme laden und als laufend markieren; fertige bleiben unverändert."""
+        out_dir.mkdir(parents=True, exist_ok=True)
+        manifest = read_manifest(out_dir) or {}
+        if manifest.get("status") == "done":
+            return manifest
+        manifest.pop("error", None)
+        manifest.update({
+            "source": str(audio_path),
+            "status": "running",
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "timings": manifest.get("timings", {}),
+        })
+        write_manifest(out_dir, manifest)
+        return manifest
+
+    @staticmethod
+    def _read_output(out_dir, filename):
+        path = out_dir / filename
+        return path.read_text(encoding="utf-8") if path.exists() else None
+
+    def _stage(self, out_dir, manifest, name, filename, produce):
+        existing = self._read_output(out_dir, filename)
+        if existing is not None:
+            return existing
+        path = out_dir / filename
+        stage_start = time.perf_counter()
+        result = produce()
+        manifest["timings"][name] = time.perf_counter() - stage_start
+        write_atomic(path, result)
+        write_manifest(out_dir, manifest)
+        return result
+
+    def _transcribe(self, audio_path):
+        audio_bytes = audio_path.read_bytes()
+        backend = self.transcription_backend
+        if self.transcription_cache is None:
+            return backend.transcribe_bytes(audio_bytes)
+        return self.transcription_cache.get_or_transcribe(audio_bytes, backend.transcribe_bytes,
+                                                          model=backend.model_id, language=self.language)
+
+    def _generate(self, transcript, manifest):
+        timings = {}
+        letter = generate_letter(
+            self.client,
+            build_messages(self.system_prompt, f"Hier ist das Gespräch:\n{transcript}"),
+            model=self.model,
+            temperature=self.temperature,
+            timings=timings
+        )
+        manifest["timings"]["generation_time_to_first_token"] = timings.get("time_to_first_token")
+        return letter
+
+    def run(self, recordings, workers=4, progress=print):
+        results = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.process, path): path for path in recordings}
+            for future in as_completed(futures):
+                manifest = future.result()
+                results.append(manifest)
+                progress(f"{manifest['status']:>7}  {futures[future].name}"
+                         + (f"  ({manifest['error']})" if manifest.get("error") else ""))
+        return results
+
+    def run_pipeline(self, recordings, client_factory=make_async_client, concurrency=None, progress=print):
+        """Wie `run`, aber über die asynchrone `LetterPipeline` statt eines Thread-Pools.
+
+        Vorhandene Zwischenergebnisse gehen in den `LetterJob`; die Pipeline überspringt
+        die Stufen, die sie erzeugen würden.
+        """
+        results = []
+        jobs = []
+        manifests = {}
+        for path in recordings:
+            out_dir = recording_dir(self.output_dir, path)
+            try:
+                manifest = self._start(out_dir, path)
+                if manifest.get("status") == "done":
+                    results.append(manifest)
+                    progress(f"{'done':>7}  {path.name}")
+                    continue
+                job = LetterJob(
+                    job_id=str(path),
+                    source=str(path),
+                    transcript=self._read_output(out_dir, "transkript.txt"),
+                    letter=self._read_output(out_dir, "arztbrief_roh.txt"),
+                    letter_with_icd=self._read_output(out_dir, "arztbrief.txt"),
+                )
+            except OSError as e:
+                manifest = {"source": str(path), "status": "failed", "error": f"{type(e).__name__}: {e}"}
+                results.append(manifest)
+                progress(f"{'failed':>7}  {path.name}  ({manifest['error']})")
+                continue
+            manifests[job.job_id] = manifest
+            jobs.append(job)
+
+        pipeline = LetterPipeline(
+            client_factory,
+            icd_map=self.icd_map,
+            system_prompt=self.system_prompt,
+            model=self.model,
+            temperature=self.temperature,
+            language=self.language,
+            logo_path=self.logo_path,
+            concurrency=concurrency,
+            transcription_cache=self.transcription_cache,
+            # whisper-1 direkt über den Async-Client, ausser dieser zeigt auf einen lokalen LLM-Endpunkt
+            transcription_backend=None if isinstance(self.transcription_backend, OpenAIWhisperBackend)
+            and not LLM_BASE_URL else self.transcription_backend,
+        )
+
+        async def drive():
+            async for job in pipeline.run(jobs):
+                manifest = self._write_job(job, manifests[job.job_id])
+                results.append(manifest)
+                progress(f"{manifest['status']:>7}  {Path(job.source).name}"
+                         + (f"  ({manifest['error']})" if manifest.get("error") else ""))
+
+        asyncio.run(drive())
+        return results
+
+    def _write_job(self, job, manifest):
+        # In das beim Start gelesene Manifest übernehmen wie in `_process`: started_at und
+        # Zeiten übersprungener Stufen aus früheren Läufen bleiben erhalten
+        out_dir = recording_dir(self.output_dir, job.source)
+        manifest["timings"].update(job.timings)
+        if "time_to_first_token" in job.generation_timings:
+            manifest["timings"]["generation_time_to_first_token"] = job.generation_timings["time_to_first_token"]
+        if job.quality_checks is not None:
+            manifest["quality_checks"] = job.quality_checks
+        manifest["status"] = "failed" if job.error else "done"
+        if job.error:
+            manifest["error"] = job.error
+        try:
+            outputs = [("transkript.txt", job.transcript), ("arztbrief_roh.txt", job.letter),
+                       ("arztbrief.txt", job.letter_with_icd)]
+            for filename, text in outputs:
+                if text is not None:
+                    write_atomic(out_dir / filename, text)
+            if job.pdf_bytes is not None:
+                write_atomic(out_dir / "arztbrief.pdf", job.pdf_bytes)
+            manifest["finished_at"] = datetime.now(timezone.utc).isoformat()
+            write_manifest(out_dir, manifest)
+        except OSError as e:
+            # Der ursprüngliche Fehler ist aussagekräftiger als der Folgefehler beim Schreiben
+            manifest["status"] = "failed"
+            manifest.setdefault("error", f"{type(e).__name__}: {e}")
+        return manifest
+
+
+def stage_limit(value):
+    stage, _, limit = value.partition("=")
+    if stage not in STAGES or not limit.isdigit() or int(limit) < 1:
+        raise argparse.ArgumentTypeError(f"erwartet STUFE=N mit STUFE aus {', '.join(STAGES)}")
+    return stage, int(limit)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Arztbriefe für alle Aufnahmen eines Ordners erzeugen.")
+    parser.add_argument("input_dir", help="Ordner mit Audiodateien")
+    parser.add_argument("-o", "--output-dir", default="arztbriefe", help="Zielordner (Standard: ./arztbriefe)")
+    parser.add_argument("-w", "--workers", type=int, help="Anzahl parallel bearbeiteter Aufnahmen (Standard: 4)")
+    parser.add_argument("--icd-file", default="icd10gm2025_codes.txt")
+    parser.add_argument("--logo", default="logo.png")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--transcript-cache-dir", default=os.environ.get("ARZTBRIEF_TRANSCRIPT_CACHE_DIR"))
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Asynchrone Stufen-Pipeline statt eines Thread-Pools verwenden")
+    parser.add_argument("--stage-concurrency", action="append", type=stage_limit, metavar="STUFE=N",
+                        help="Parallelität einer Pipeline-Stufe, z. B. transcribe=8 (mehrfach angebbar)")
+    args = parser.parse_args(argv)
+    if args.pipeline and args.workers is not None:
+        parser.error("--workers gilt nicht für --pipeline; dort --stage-concurrency STUFE=N verwenden")
+    if args.stage_concurrency and not args.pipeline:
+        parser.error("--stage-concurrency setzt --pipeline voraus")
+
+    recordings = find_recordings(args.input_dir)
+    if not recordings:
+        print(f"Keine Audiodateien in {args.input_dir} gefunden.")
+        return 1
+
+    runner = BatchRunner(
+        get_openai_client(),
+        load_icd_catalog(args.icd_file),
+        args.output_dir,
+        model=args.model,
+        logo_path=args.logo,
+        transcription_cache=TranscriptionCache(cache_dir=args.transcript_cache_dir),
+    )
+    start = time.perf_counter()
+    if args.pipeline:
+        results = runner.run_pipeline(recordings, concurrency=dict(args.stage_concurrency or []))
+    else:
+        results = runner.run(recordings, workers=args.workers or 4)
+    failed = sum(1 for m in results if m["status"] != "done")
+    print(f"{len(results) - failed}/{len(results)} Arztbriefe erstellt in {time.perf_counter() - start:.1f}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
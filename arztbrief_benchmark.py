@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import gc
+import io
+import json
+import math
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+import openai
+
+from arztbrief_report import check_report_quality, create_pdf_report, find_icd_codes_in_text, insert_icds_into_diagnosis
+from icd_catalog import COLUMNS, compile_catalog, load_catalog
+from letter_pipeline import LetterJob, LetterPipeline
+from letter_sections import parse_letter
+from mock_llm_server import CANNED_LETTERS, start_mock_server
+from pdf_rendering import clear_asset_cache
+
+# Offline-Benchmarks für ICD-Suche, Regelprüfung, PDF und die komplette Pipeline.
+# Synthetischer Katalog, Beispielbriefe und Mock-LLM sind über Seeds reproduzierbar,
+# sodass zwei Läufe (z. B. vor/nach einer Änderung) mit --json/--compare vergleichbar sind.
+
+MEDICAL_TERMS = [
+    "akute", "chronische", "bronchitis", "pneumonie", "diabetes", "mellitus", "typ", "hypertonie",
+    "essentielle", "fraktur", "femur", "tibia", "gonarthrose", "koxarthrose", "primäre", "niereninsuffizienz",
+    "herzinsuffizienz", "vorhofflimmern", "asthma", "bronchiale", "lumbago", "migräne", "depression",
+    "angststörung", "karzinom", "mamma", "prostata", "lunge", "leber", "zirrhose", "hepatitis", "gastritis",
+    "ulkus", "ventriculi", "appendizitis", "cholezystitis", "pankreatitis", "arthritis", "rheumatoide",
+    "osteoporose", "skoliose", "bandscheibenvorfall", "rechts", "links", "beidseits", "mit", "ohne",
+    "komplikationen", "nicht", "näher", "bezeichnet", "sonstige", "des", "der",
+]
+
+
+def write_synthetic_catalog(path, entries=16000, seed=1):
+    """Katalog im Format von icd10gm2025_codes.txt; liefert die erzeugten Beschreibungen."""
+    rng = random.Random(seed)
+    vocabulary = MEDICAL_TERMS + [f"begriff{i}" for i in range(3000)]
+    descriptions = set()
+    with open(path, "w", encoding="utf-8") as f:
+        while len(descriptions) < entries:
+            desc = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(2, 7))).capitalize()
+            if desc.lower() in descriptions:
+                continue
+            descriptions.add(desc.lower())
+            row = dict.fromkeys(COLUMNS, "")
+            row.update({
+                "Stufe": "4",
+                "ID": str(len(descriptions)),
+                "Ebene": "T",
+                "Code": f"{rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')}{rng.randint(0, 99):02d}.{rng.randint(0, 9)}",
+                "Beschreibung": desc,
+            })
+            f.write("|".join(row[c] for c in COLUMNS) + "\n")
+    return sorted(descriptions)
+
+
+def sample_letters(descriptions, count=50, seed=2):
+    rng = random.Random(seed)
+    letters = []
+    for _ in range(count):
+        base = rng.choice(CANNED_LETTERS)
+        sections = []
+        for title, content in base["abschnitte"]:
+            if title == "Diagnose":
+                content = ", ".join([content] + [d.capitalize() for d in rng.sample(descriptions, 2)])
+            elif title == "Anamnese":
+                content = " ".join([content] * rng.randint(1, 8))
+            sections.append(f"{title}\n{content}")
+        letters.append("\n\n".join(sections))
+    return letters
+
+
+def synthetic_wav(seconds=3, rate=16000):
+    # Kleine WAV-Datei geht ohne ffmpeg-Umwandlung direkt an die (Mock-)Transkription
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"".join(struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / rate)))
+                               for i in range(seconds * rate)))
+    return buffer.getvalue()
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples, peak_bytes=None):
+    return {
+        "n": len(samples),
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "peak_kib": peak_bytes / 1024 if peak_bytes is not None else None,
+    }
+
+
+def reset_letter_caches(icd_map):
+    # Ohne Zurücksetzen misst jede Runde nach der ersten nur Treffer aus Parse- und Fuzzy-Cache
+    parse_letter.cache_clear()
+    icd_map.clear_memo()
+
+
+def measure(fn, inputs, rounds=3, reset=None):
+    """p50/p95 und Speicherspitze; `reset` läuft vor jedem Aufruf ausserhalb der Zeitmessung."""
+    reset = reset or (lambda: None)
+    reset()
+    fn(inputs[0])
+    samples = []
+    for _ in range(rounds):
+        for item in inputs:
+            reset()
+            start = time.perf_counter()
+            fn(item)
+            samples.append(time.perf_counter() - start)
+
+    # Speicherspitze separat messen, tracemalloc würde die Zeiten verfälschen
+    gc.collect()
+    tracemalloc.start()
+    for item in inputs[:5]:
+        reset()
+        fn(item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarize(samples, peak)
+
+
+def bench_pipeline(icd_map, jobs=20, time_to_first_token=0.05, tokens_per_second=400.0,
+                   transcription_seconds=0.05, concurrency=None):
+    server = start_mock_server(port=0, time_to_first_token=time_to_first_token,
+                               tokens_per_second=tokens_per_second, transcription_seconds=transcription_seconds)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    pipeline = LetterPipeline(
+        lambda: openai.AsyncOpenAI(api_key="benchmark", base_url=base_url),
+        icd_map=icd_map,
+        concurrency=concurrency,
+    )
+    audio = synthetic_wav()
+
+    async def run():
+        start = time.perf_counter()
+        latencies, stages = [], {}
+        batch = [LetterJob(job_id=str(i), audio_bytes=audio) for i in range(jobs)]
+        async for job in pipeline.run(batch):
+            if job.error:
+                raise RuntimeError(job.error)
+            latencies.append(time.perf_counter() - start)
+            for stage, seconds in job.timings.items():
+                stages.setdefault(stage, []).append(seconds)
+        return time.perf_counter() - start, latencies, stages
+
+    try:
+        wall, latencies, stages = asyncio.run(run())
+    finally:
+        server.shutdown()
+    results = {"pipeline_end_to_end": {**summarize(latencies), "throughput_per_s": jobs / wall}}
+    for stage, samples in stages.items():
+        results[f"pipeline_stage_{stage}"] = summarize(samples)
+    return results
+
+
+def run_benchmarks(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "icd_synthetisch.txt")
+        catalog = os.path.join(tmp, "icd_synthetisch.sqlite")
+        descriptions = write_synthetic_catalog(source, entries=args.entries)
+
+        start = time.perf_counter()
+        compile_catalog(source, catalog)
+        results["catalog_compile"] = summarize([time.perf_counter() - start])
+        results["catalog_load"] = measure(lambda _: load_catalog(catalog), [None], rounds=5)
+        icd_map = load_catalog(catalog)
+
+    letters = sample_letters(descriptions, count=args.letters)
+    pdf_inputs = [insert_icds_into_diagnosis(letter, icd_map) for letter in letters]
+
+    # Dieselben Briefe laufen mehrmals durch; gemessen werden sollen die Kosten eines neuen Briefs
+    def cold():
+        reset_letter_caches(icd_map)
+
+    results["icd_lookup"] = measure(lambda text: find_icd_codes_in_text(text, icd_map), letters, rounds=args.rounds,
+                                    reset=cold)
+    results["icd_insert"] = measure(lambda text: insert_icds_into_diagnosis(text, icd_map), letters,
+                                    rounds=args.rounds, reset=cold)
+    results["quality_checks"] = measure(check_report_quality, pdf_inputs, rounds=args.rounds, reset=cold)
+    results["pdf_render"] = measure(lambda text: create_pdf_report(text, logo_path=args.logo), pdf_inputs,
+                                    rounds=args.rounds, reset=cold)
+
+    # Wie vor dem Asset-Cache: Stylesheet und Logo bei jedem Aufruf neu aufbereiten
+    def render_cold(text):
+        clear_asset_cache()
+        return create_pdf_report(text, logo_path=args.logo)
+
+    results["pdf_render_cold"] = measure(render_cold, pdf_inputs, rounds=args.rounds, reset=cold)
+
+    if not args.skip_pipeline:
+        results.update(bench_pipeline(
+            icd_map,
+            jobs=args.pipeline_jobs,
+            time_to_first_token=args.ttft,
+            tokens_per_second=args.tokens_per_second,
+            transcription_seconds=args.transcription_seconds,
+        ))
+
+    # ru_maxrss ist unter Linux in KiB, unter macOS in Bytes
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results["process"] = {"max_rss_kib": max_rss / 1024 if sys.platform == "darwin" else max_rss}
+    return results
+
+
+def print_report(results, baseline=None):
+    print(f"{'Benchmark':<34}{'n':>6}{'p50 ms':>11}{'p95 ms':>11}{'Peak KiB':>11}")
+    for name, r in results.items():
+        if "p50_ms" not in r:
+            continue
+        peak = f"{r['peak_kib']:.0f}" if r.get("peak_kib") is not None else "–"
+        line = f"{name:<34}{r['n']:>6}{r['p50_ms']:>11.2f}{r['p95_ms']:>11.2f}{peak:>11}"
+        old = (baseline or {}).get(name)
+        if old and old.get("p50_ms"):
+            line += (f"   p50 {(r['p50_ms'] / old['p50_ms'] - 1) * 100:+.0f}%"
+                     f" p95 {(r['p95_ms'] / old['p95_ms'] - 1) * 100:+.0f}%")
+        print(line)
+    if "pipeline_end_to_end" in results:
+        print(f"Pipeline-Durchsatz: {results['pipeline_end_to_end']['throughput_per_s']:.1f} Briefe/s")
+    print(f"Max. RSS: {results['process']['max_rss_kib'] / 1024:.0f} MiB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline-Benchmarks für ICD-Suche, PDF und Pipeline.")
+    parser.add_argument("--entries", type=int, default=16000, help="Grösse des synthetischen ICD-Katalogs")
+    parser.add_argument("--letters", type=int, default=50, help="Anzahl Beispielbriefe")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--logo", default="logo.png")
+    parser.add_argument("--skip-pipeline", action="store_true")
+    parser.add_argument("--pipeline-jobs", type=int, default=20)
+    parser.add_argument("--ttft", type=float, default=0.05, help="Mock: Sekunden bis zum ersten Token")
+    parser.add_argument("--tokens-per-second", type=float, default=400.0)
+    parser.add_argument("--transcription-seconds", type=float, default=0.05)
+    parser.add_argument("--json", help="Ergebnisse als JSON speichern")
+    parser.add_argument("--compare", help="Früheres JSON-Ergebnis als Vergleichsbasis")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
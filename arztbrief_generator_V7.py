@@ -1,17 +1,30 @@
 import streamlit as st
-import base64
-import tempfile
 import os
-from openai import OpenAI
+from openai_client import get_openai_client
 from io import BytesIO
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate
 import streamlit.components.v1 as components
 from streamlit_js_eval import streamlit_js_eval
+from recording_transport import (
+    RecordingStore, start_upload_server, recorder_html, upload_origins, upload_url, RECORDING_ID_LISTENER_JS
+)
+from transcription_backends import get_transcription_backend
+from audio_processing import sniff_format
+from live_transcription import LiveTranscriber
+from letter_generation import build_messages, stream_letter, format_timings
+from metrics import ensure_metrics_server, traced
+from pdf_rendering import section_flowables
+from pdf_cache import PdfCache
 
 # OpenAI setup
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+client = get_openai_client(st.secrets["OPENAI_API_KEY"])
+transcription_backend = get_transcription_backend(client)
+ensure_metrics_server()
+
+# Der Browser lädt direkt zu diesem Port hoch; er muss wie der Streamlit-Port erreichbar sein
+# (siehe .devcontainer/devcontainer.json und recording_transport.upload_url)
+UPLOAD_PORT = int(os.environ.get("ARZTBRIEF_UPLOAD_PORT", "8502"))
 
 st.set_page_config(page_title="🎤 Arztbrief aus Browser-Aufnahme", layout="centered")
 st.title("🎤 Arztbrief aus Browser-Aufnahme")
@@ -22,119 +35,95 @@ Ein strukturierter Arztbrief wird automatisch erstellt.
 """)
 
 # PDF-Erstellung ausgelagert
+@traced("pdf_render")
 def create_pdf_report(brief_text):
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=50, bottomMargin=50)
-    styles = getSampleStyleSheet()
     elements = []
-    for section in brief_text.split("\n\n"):
-        lines = section.strip().split("\n", 1)
-        if len(lines) == 2:
-            heading, content = lines
-            elements.append(Paragraph(f"<b>{heading}:</b>", styles["Heading4"]))
-            elements.append(Paragraph(content.strip().replace("\n", "<br/>"), styles["BodyText"]))
-            elements.append(Spacer(1, 12))
+    elements.extend(section_flowables(brief_text))
     doc.build(elements)
     buffer.seek(0)
     return buffer
 
-# HTML/JS Recorder
-components.html("""
-<script>
-let mediaRecorder;
-let audioChunks = [];
-function startRecording() {
-    document.getElementById("status").innerText = "🔴 Aufnahme läuft...";
-    navigator.mediaDevices.getUserMedia({ audio: true })
-        .then(stream => {
-            mediaRecorder = new MediaRecorder(stream);
-            audioChunks = [];
-            mediaRecorder.ondataavailable = event => {
-                audioChunks.push(event.data);
-            };
-            mediaRecorder.onstop = () => {
-                document.getElementById("status").innerText = "✅ Aufnahme abgeschlossen.";
-                const blob = new Blob(audioChunks, { type: 'audio/webm' });
-                const reader = new FileReader();
-                reader.readAsDataURL(blob);
-                reader.onloadend = () => {
-                    const base64data = reader.result;
-                    window.parent.postMessage({ type: 'FROM_IFRAME', base64: base64data }, '*');
-                };
-            };
-            mediaRecorder.start();
-        });
-}
-function stopRecording() {
-    if (mediaRecorder && mediaRecorder.state === "recording") {
-        mediaRecorder.stop();
-    }
-}
-</script>
-<div>
-    <button onclick="startRecording()">🎙️ Aufnahme starten</button>
-    <button onclick="stopRecording()">⏹️ Aufnahme stoppen</button>
-    <p id="status" style="font-weight:bold; color:darkred;"></p>
-</div>
-""", height=200)
+@st.cache_resource
+def get_pdf_cache():
+    return PdfCache()
+
+pdf_cache = get_pdf_cache()
+
+@st.cache_resource
+def get_recording_store(_backend):
+    store = RecordingStore()
+    live_transcriber = LiveTranscriber(store, _backend.transcribe)
+    return store, live_transcriber
+
+@st.cache_resource
+def get_upload_server(_store):
+    # Ein OSError (Port belegt) wird nicht gecacht; beim nächsten Rerun wird erneut versucht
+    return start_upload_server(
+        _store,
+        host=os.environ.get("ARZTBRIEF_UPLOAD_HOST", "127.0.0.1"),
+        port=UPLOAD_PORT,
+        allowed_origins=upload_origins(st.get_option("server.port")),
+    )
+
+recording_store, live_transcriber = get_recording_store(transcription_backend)
+
+try:
+    get_upload_server(recording_store)
+    upload_ready = True
+except OSError as e:
+    st.error(f"❌ Upload-Server für Browser-Aufnahmen konnte nicht starten (Port {UPLOAD_PORT}): {e}")
+    upload_ready = False
+
+# Aufnahme-ID und Token werden pro Sitzung vergeben; nur diese ID wird vom Recorder angenommen.
+# Einen Platz im Store belegt die Aufnahme erst, wenn im Browser die Aufnahme startet.
+if upload_ready and st.session_state.get("upload_recording") is None:
+    st.session_state.upload_recording = recording_store.issue()
+
+if upload_ready:
+    # HTML/JS Recorder: lädt die Audiodaten schon während der Aufnahme stückweise hoch
+    issued_id, issued_token = st.session_state.upload_recording
+    components.html(
+        recorder_html(issued_id, issued_token, upload_url(UPLOAD_PORT), upload_port=UPLOAD_PORT),
+        height=200,
+    )
 
 # JS listener
-js_code = """
-await new Promise(resolve => {
-  window.addEventListener('message', (event) => {
-    if (event.data && event.data.base64) {
-      resolve(event.data.base64);
-    }
-  }, { once: true });
-})
-"""
-
-if "audio_base64" not in st.session_state:
-    st.session_state.audio_base64 = None
+js_code = RECORDING_ID_LISTENER_JS
+
+if "recording_id" not in st.session_state:
+    st.session_state.recording_id = None
 if "transcription_done" not in st.session_state:
     st.session_state.transcription_done = False
 
 js_response = streamlit_js_eval(js_expressions=js_code, key="recorder", trigger=True)
 
-if js_response and js_response != st.session_state.get("audio_base64"):
-    st.session_state.audio_base64 = js_response
+issued = st.session_state.get("upload_recording")
+if js_response and issued and js_response == issued[0]:
+    st.session_state.recording_id = js_response
+    st.session_state.upload_recording = None
     st.session_state.transcription_done = False
-    st.experimental_rerun()
+    st.rerun()
 
-if st.session_state.get("audio_base64") and not st.session_state.get("transcription_done", False):
+if st.session_state.get("recording_id") and not st.session_state.get("transcription_done", False):
     st.success("📥 Audio wurde empfangen und wird transkribiert...")
-    audio_bytes = base64.b64decode(st.session_state.audio_base64.split(",")[1])
-    st.audio(audio_bytes, format="audio/webm")
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp:
-        tmp.write(audio_bytes)
-        tmp_path = tmp.name
-
-    try:
-        with open(tmp_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="de"
-            )
-    except Exception as e:
-        import subprocess
-        import uuid
-        st.warning("⚠️ Ursprüngliche Datei konnte nicht verarbeitet werden. Versuche WAV-Konvertierung...")
-        wav_path = tmp_path.replace(".webm", f"_{uuid.uuid4().hex}.wav")
-        subprocess.run(["ffmpeg", "-y", "-i", tmp_path, wav_path], check=True)
-        with open(wav_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="de"
-            )
-        os.remove(wav_path)
-    os.remove(tmp_path)
-
-    st.session_state.transcription_text = transcript.text
+    # Der Grossteil wurde schon während der Aufnahme transkribiert, hier fehlt nur der letzte Abschnitt
+    transcript_text = live_transcriber.result(st.session_state.recording_id, timeout=300)
+    audio_bytes = recording_store.pop(st.session_state.recording_id)
+    if audio_bytes is None:
+        st.error("❌ Die Aufnahme ist auf dem Server nicht mehr vorhanden. Bitte erneut aufnehmen.")
+        st.session_state.recording_id = None
+        st.stop()
+    # Safari nimmt MP4 statt WebM auf
+    st.audio(audio_bytes, format=f"audio/{sniff_format(audio_bytes) or 'webm'}")
+
+    if transcript_text is None:
+        transcript_text = transcription_backend.transcribe_bytes(audio_bytes)
+
+    st.session_state.transcription_text = transcript_text
     st.session_state.transcription_done = True
-    st.write("📝 Transkriptionstext (Ausschnitt):", transcript.text[:300])
+    st.write("📝 Transkriptionstext (Ausschnitt):", transcript_text[:300])
 
 st.divider()
 
@@ -145,60 +134,36 @@ if uploaded_file:
     st.success("📥 Datei erfolgreich hochgeladen.")
     st.session_state.transcription_done = False
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp:
-        tmp.write(uploaded_file.read())
-        tmp_path = tmp.name
-
-    try:
-        with open(tmp_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="de"
-            )
-    except Exception as e:
-        import subprocess
-        import uuid
-        st.warning("⚠️ Die Datei konnte nicht direkt verarbeitet werden. Versuche WAV-Konvertierung...")
-        wav_path = tmp_path.replace(".webm", f"_{uuid.uuid4().hex}.wav")
-        subprocess.run(["ffmpeg", "-y", "-i", tmp_path, wav_path], check=True)
-        with open(wav_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="de"
-            )
-        os.remove(wav_path)
-
-    os.remove(tmp_path)
-    st.session_state.audio_base64 = None
-    st.session_state.transcription_text = transcript.text
+    transcript_text = transcription_backend.transcribe_bytes(uploaded_file.getvalue())
+    st.session_state.recording_id = None
+    st.session_state.transcription_text = transcript_text
     st.session_state.transcription_done = True
     st.audio(uploaded_file, format="audio/webm")
-    st.write("📝 Transkriptionstext (Ausschnitt):", transcript.text[:300])
+    st.write("📝 Transkriptionstext (Ausschnitt):", transcript_text[:300])
 
 # GPT Analyse + PDF
 if st.session_state.transcription_done:
     if st.button("🧠 Arztbrief generieren mit GPT"):
-        with st.spinner("💬 GPT erstellt den Arztbrief..."):
-            system_prompt = """
-            Du bist ein medizinischer Assistent, der aus Transkripten strukturierte Arztbriefe erstellt.
-            Gliedere in: Anamnese, Diagnose, Therapie, Aufklärung, Organisatorisches, Operationsplanung, Patientenwunsch.
-            Füge drei passende ICD-10-Codes unter Diagnose hinzu (Format: Bezeichnung → Code).
-            """
-            chat = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": st.session_state.transcription_text}
-                ],
-                temperature=0.3
-            )
-            report = chat.choices[0].message.content.strip()
-
-            st.subheader("📄 Arztbrief")
-            st.text_area("Arztbrief mit ICD-10-Codes", report, height=400)
-
-            pdf_buffer = create_pdf_report(report)
-            st.download_button("⬇️ PDF herunterladen", data=pdf_buffer, file_name="arztbrief.pdf", mime="application/pdf")
-            st.download_button("⬇️ Arztbrief als Textdatei", report, file_name="arztbrief.txt")
+        system_prompt = """
+        Du bist ein medizinischer Assistent, der aus Transkripten strukturierte Arztbriefe erstellt.
+        Gliedere in: Anamnese, Diagnose, Therapie, Aufklärung, Organisatorisches, Operationsplanung, Patientenwunsch.
+        Füge drei passende ICD-10-Codes unter Diagnose hinzu (Format: Bezeichnung → Code).
+        """
+        st.caption("💬 GPT erstellt den Arztbrief...")
+        generation_timings = {}
+        with st.container(border=True):
+            report = st.write_stream(stream_letter(
+                client,
+                build_messages(system_prompt, st.session_state.transcription_text),
+                timings=generation_timings
+            )).strip()
+        st.caption(format_timings(generation_timings))
+
+        st.subheader("📄 Arztbrief")
+        st.text_area("Arztbrief mit ICD-10-Codes", report, height=400)
+
+        # PDF erst beim Klick rendern; unveränderter Brief kommt beim nächsten Download aus dem Cache
+        pdf_key = pdf_cache.make_key(report)
+        st.download_button("⬇️ PDF herunterladen", data=pdf_cache.download_data(pdf_key, create_pdf_report, report),
+                           file_name="arztbrief.pdf", mime="application/pdf", on_click="ignore")
+        st.download_button("⬇️ Arztbrief als Textdatei", report, file_name="arztbrief.txt")
@@ -1,15 +1,19 @@
 import streamlit as st
-import tempfile
 import os
-import subprocess
-import uuid
 import mimetypes
-from openai import OpenAI
+import time
+import uuid
+from openai_client import get_openai_client
 from io import BytesIO
-from reportlab.platypus import Image, Paragraph, Spacer, SimpleDocTemplate
+from reportlab.platypus import SimpleDocTemplate
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_RIGHT
+from transcription_cache import TranscriptionCache
+from generation_cache import GenerationCache
+from pdf_cache import PdfCache
+from transcription_backends import get_transcription_backend
+from letter_generation import build_messages, stream_letter, format_timings, generate_letter_variants
+from metrics import METRICS, current_trace, ensure_metrics_server, traced
+from pdf_rendering import load_letterheads, section_flowables
 
 st.set_page_config(page_title="📄 Arztbrief aus Audio-Datei", layout="centered")
 st.title("📄 Arztbrief aus Audio-Datei")
@@ -29,53 +33,57 @@ if not api_key:
     st.info("Bitte gib deinen OpenAI API-Key ein, um fortzufahren.")
     st.stop()
 
-client = OpenAI(api_key=api_key)
+client = get_openai_client(api_key)
+transcription_backend = get_transcription_backend(client)
+ensure_metrics_server()
+
+# Messwerte dieser Sitzung tragen dieselbe Trace-ID (JSONL-Log und Debug-Panel)
+if "trace_id" not in st.session_state:
+    st.session_state.trace_id = uuid.uuid4().hex[:12]
+current_trace.set(st.session_state.trace_id)
+
+@st.cache_resource
+def get_transcription_cache():
+    return TranscriptionCache(cache_dir=os.environ.get("ARZTBRIEF_TRANSCRIPT_CACHE_DIR"))
+
+@st.cache_resource
+def get_generation_cache():
+    return GenerationCache(cache_dir=os.environ.get("ARZTBRIEF_GENERATION_CACHE_DIR"))
+
+@st.cache_resource
+def get_pdf_cache():
+    return PdfCache()
+
+transcription_cache = get_transcription_cache()
+generation_cache = get_generation_cache()
+pdf_cache = get_pdf_cache()
 
-def create_pdf_report(brief_text, mit_briefkopf=False, logo_path="logo.png"):
+GENERATION_MODEL = "gpt-4o"
+GENERATION_TEMPERATURE = 0.3
+
+def use_cached_brief(brief_text, key):
+    st.session_state.arztbrief = brief_text
+    st.session_state.arztbrief_key = key
+    st.session_state.generation_timings = {}
+    st.session_state.generation_cached = True
+    st.session_state.arztbrief_generiert = True
+
+@traced("pdf_render")
+def create_pdf_report(brief_text, letterhead=None):
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=50, bottomMargin=50)
-    styles = getSampleStyleSheet()
     elements = []
 
-    if mit_briefkopf:
-        try:
-            logo = Image(logo_path, width=140, height=25)
-            logo.hAlign = 'RIGHT'
-            elements.append(logo)
-            elements.append(Spacer(1, 6))
-        except Exception as e:
-            st.warning(f"⚠️ Logo konnte nicht geladen werden: {e}")
-
-        right_align = ParagraphStyle(name="Right", parent=styles["Normal"], alignment=TA_RIGHT)
-        briefkopf_text = Paragraph(
-            """
-            <b>Kantonsspital Winterthur</b><br/>
-            Brauersstrasse 15, Postfach<br/>
-            8401 Winterthur<br/><a href='https://www.ksw.ch'>www.ksw.ch</a><br/><br/>
-            <b>Klinik für Radiologie und Nuklearmedizin</b><br/>
-            Prof. Dr. med. Roman Guggenberger<br/>
-            Chefarzt und Klinikleiter<br/><br/>
-            Diagnostische Radiologie<br/>
-            Chefarzt Dr. Valentin Fretz<br/><br/>
-            Nuklearmedizin<br/>
-            Chefarzt PD Dr. Bernd Klaeser<br/><br/>
-            Interventionelle Radiologie<br/>
-            Stv. Chefarzt PD Dr. Arash Najafi
-            """,
-            style=right_align
-        )
-        elements.append(briefkopf_text)
-        elements.append(Spacer(1, 20))
-
-    for section in brief_text.split("\n\n"):
-        lines = section.strip().split("\n", 1)
-        if len(lines) == 2:
-            heading, content = lines
-            elements.append(Paragraph(heading + ":", styles["Heading4"]))
-            elements.append(Paragraph(content.strip().replace("\n", "<br/>"), styles["BodyText"]))
-            elements.append(Spacer(1, 12))
-
-    doc.build(elements)
+    # Briefkopf (letterheads.json) ist vorgerendert und wird nur auf die erste Seite gestempelt
+    if letterhead is not None:
+        elements.append(letterhead.spacer())
+
+    elements.extend(section_flowables(brief_text, heading_format="{}:"))
+
+    if letterhead is not None:
+        doc.build(elements, onFirstPage=letterhead.stamp)
+    else:
+        doc.build(elements)
     buffer.seek(0)
     return buffer
 
@@ -88,42 +96,24 @@ if uploaded_file:
     st.success("📅 Datei erfolgreich hochgeladen.")
     st.session_state.transcription_done = False
 
-    with st.spinner("🔍 Transkription läuft..."):
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as tmp:
-            tmp.write(uploaded_file.read())
-            tmp_path = tmp.name
-
-        try:
-            with open(tmp_path, "rb") as audio_file:
-                transcript = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="de"
-                )
-        except Exception:
-            st.warning("⚠️ Ursprüngliche Datei konnte nicht verarbeitet werden. Versuche WAV-Konvertierung...")
-            wav_path = tmp_path.replace(".webm", f"_{uuid.uuid4().hex}.wav")
-            subprocess.run(["ffmpeg", "-y", "-i", tmp_path, wav_path], check=True)
+    audio_bytes = uploaded_file.getvalue()
+    cache_key = transcription_cache.make_key(audio_bytes, model=transcription_backend.model_id, language="de")
+    transcript_text = transcription_cache.get(cache_key)
 
+    if transcript_text is None:
+        with st.spinner("🔍 Transkription läuft..."):
             try:
-                with open(wav_path, "rb") as audio_file:
-                    transcript = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=audio_file,
-                        language="de"
-                    )
-            except Exception as inner_e:
-                st.error(f"❌ Auch WAV konnte nicht verarbeitet werden. Fehler: {inner_e}")
+                transcript_text = transcription_backend.transcribe_bytes(audio_bytes)
+            except Exception as e:
+                st.error(f"❌ Audiodatei konnte nicht verarbeitet werden. Fehler: {e}")
                 st.stop()
-            finally:
-                os.remove(wav_path)
+        transcription_cache.put(cache_key, transcript_text)
 
-        os.remove(tmp_path)
-        st.session_state.transcription_text = transcript.text
-        st.session_state.transcription_done = True
-        st.audio(uploaded_file, format="audio/webm")
-        st.write("📝 Transkriptionstext (Ausschnitt):", transcript.text[:300])
-        st.download_button("⬇️ Transkript herunterladen", transcript.text, file_name="transkript.txt")
+    st.session_state.transcription_text = transcript_text
+    st.session_state.transcription_done = True
+    st.audio(uploaded_file, format="audio/webm")
+    st.write("📝 Transkriptionstext (Ausschnitt):", transcript_text[:300])
+    st.download_button("⬇️ Transkript herunterladen", transcript_text, file_name="transkript.txt")
 
 if st.session_state.transcription_done:
     struktur_optionen = {
@@ -153,28 +143,112 @@ Gliedere in: Informationsstand der Angehörigen, besprochene Inhalte, Fragen und
     if "arztbrief_generiert" not in st.session_state:
         st.session_state.arztbrief_generiert = False
 
-    if st.button("🧠 Arztbrief generieren mit GPT"):
-        with st.spinner("💬 GPT erstellt den Arztbrief..."):
-            chat = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": st.session_state.transcription_text}
-                ],
-                temperature=0.3
-            )
-            st.session_state.arztbrief = chat.choices[0].message.content.strip()
+    generation_key = generation_cache.make_key(
+        system_prompt, st.session_state.transcription_text, GENERATION_MODEL, GENERATION_TEMPERATURE
+    )
+
+    # Bereits erzeugte Strukturtypen (z. B. aus der Parallel-Erstellung) beim Umschalten sofort anzeigen
+    if st.session_state.get("arztbrief_key") != generation_key:
+        cached_brief = generation_cache.get(generation_key)
+        if cached_brief is not None:
+            use_cached_brief(cached_brief, generation_key)
+
+    with st.expander("⚡ Mehrere Strukturtypen parallel erstellen"):
+        parallel_auswahl = st.multiselect(
+            "Strukturtypen", list(struktur_optionen.keys()), default=[ausgewählte_struktur]
+        )
+        if st.button("🚀 Ausgewählte Strukturtypen parallel generieren", disabled=not parallel_auswahl):
+            status = st.empty()
+            fertig = []
+
+            def melde_fertig(name, result):
+                fertig.append(name)
+                status.caption(f"✅ {len(fertig)}/{len(parallel_auswahl)} fertig: {', '.join(fertig)}")
+
+            with st.spinner("💬 GPT erstellt die Arztbriefe parallel..."):
+                start = time.perf_counter()
+                varianten = generate_letter_variants(
+                    client,
+                    {name: struktur_optionen[name] for name in parallel_auswahl},
+                    st.session_state.transcription_text,
+                    model=GENERATION_MODEL,
+                    temperature=GENERATION_TEMPERATURE,
+                    cache=generation_cache,
+                    max_workers=len(parallel_auswahl),
+                    on_result=melde_fertig
+                )
+            fehler = {name: e for name, e in varianten.items() if isinstance(e, Exception)}
+            for name, e in fehler.items():
+                st.error(f"❌ {name}: {e}")
+            st.success(f"📄 {len(varianten) - len(fehler)} Arztbriefe in {time.perf_counter() - start:.1f} s erstellt. "
+                       "Wechsle oben den Strukturtyp, um sie anzuzeigen.")
+            aktuell = varianten.get(ausgewählte_struktur)
+            if isinstance(aktuell, str):
+                use_cached_brief(aktuell, generation_key)
+
+    col_generate, col_regenerate = st.columns(2)
+    generate_clicked = col_generate.button("🧠 Arztbrief generieren mit GPT")
+    regenerate_clicked = col_regenerate.button("🔄 Neu generieren (Cache umgehen)")
+
+    if generate_clicked or regenerate_clicked:
+        cached_brief = None if regenerate_clicked else generation_cache.get(generation_key)
+        if cached_brief is not None:
+            use_cached_brief(cached_brief, generation_key)
+        else:
+            st.caption("💬 GPT erstellt den Arztbrief...")
+            generation_timings = {}
+            with st.container(border=True):
+                brief_text = st.write_stream(stream_letter(
+                    client,
+                    build_messages(system_prompt, st.session_state.transcription_text),
+                    model=GENERATION_MODEL,
+                    temperature=GENERATION_TEMPERATURE,
+                    timings=generation_timings
+                ))
+            st.session_state.arztbrief = brief_text.strip()
+            st.session_state.generation_timings = generation_timings
+            st.session_state.generation_cached = False
+            generation_cache.put(generation_key, st.session_state.arztbrief)
+            st.session_state.arztbrief_key = generation_key
             st.session_state.arztbrief_generiert = True
 
     if st.session_state.arztbrief_generiert:
         st.subheader("📄 Generierter Arztbrief")
+        if st.session_state.get("generation_cached"):
+            st.caption("⚡ Aus dem Cache geladen – kein erneuter GPT-Aufruf.")
+        elif st.session_state.get("generation_timings"):
+            st.caption(format_timings(st.session_state.generation_timings))
         edited_report = st.text_area("✏️ Arztbrief bearbeiten (optional)", st.session_state.arztbrief.replace("*", ""), height=400)
 
-        pdf_layout = st.selectbox("🖨️ PDF-Layout wählen", ["Standard (nur Text)", "Mit Logo & Briefkopf"], key="layout_select")
-        briefkopf_aktiv = pdf_layout == "Mit Logo & Briefkopf"
-
-        if st.button("📄 PDF jetzt generieren", key="generate_pdf"):
-            pdf_buffer = create_pdf_report(edited_report, mit_briefkopf=briefkopf_aktiv)
-            st.download_button("⬇️ PDF herunterladen", data=pdf_buffer, file_name="arztbrief.pdf", mime="application/pdf")
+        try:
+            briefkoepfe = {lh.name: lh for lh in load_letterheads().values()}
+        except Exception as e:
+            st.warning(f"⚠️ Briefköpfe konnten nicht geladen werden: {e}")
+            briefkoepfe = {}
+        pdf_layout = st.selectbox("🖨️ PDF-Layout wählen", ["Standard (nur Text)", *briefkoepfe], key="layout_select")
+        briefkopf = briefkoepfe.get(pdf_layout)
+
+        # PDF erst beim Klick rendern; unveränderter Brief im selben Layout kommt aus dem Cache
+        pdf_key = pdf_cache.make_key(edited_report, layout=pdf_layout,
+                                     template_version=briefkopf.version if briefkopf else None)
+        st.download_button("⬇️ PDF herunterladen", data=pdf_cache.download_data(pdf_key, create_pdf_report, edited_report,
+                                                                                letterhead=briefkopf),
+                           file_name="arztbrief.pdf", mime="application/pdf", on_click="ignore")
 
         st.download_button("⬇️ Arztbrief als Textdatei", edited_report, file_name="arztbrief.txt")
+
+if os.environ.get("ARZTBRIEF_DEBUG_PANEL"):
+    with st.sidebar.expander("🐞 Messwerte dieser Sitzung", expanded=True):
+        events = METRICS.recent(trace=st.session_state.trace_id)
+        if not events:
+            st.caption("Noch keine Messwerte.")
+        else:
+            st.dataframe([{
+                "Stufe": e["stage"],
+                "Dauer (ms)": round(e["duration_s"] * 1000, 1),
+                "Eingabe": e.get("input_size"),
+                "Ausgabe": e.get("output_size"),
+                "Prompt-Tokens": e.get("prompt_tokens"),
+                "Completion-Tokens": e.get("completion_tokens"),
+                "Fehler": "⚠️" if e.get("error") else "",
+            } for e in reversed(events)], hide_index=True)
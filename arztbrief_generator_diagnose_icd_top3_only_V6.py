@@ -1,17 +1,21 @@
 import streamlit as st
 import base64
-import tempfile
-import os
-from openai import OpenAI
+from openai_client import get_openai_client
 from io import BytesIO
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate
 import streamlit.components.v1 as components
 from streamlit_js_eval import streamlit_js_eval
+from transcription_backends import get_transcription_backend
+from letter_generation import build_messages, stream_letter, format_timings
+from metrics import ensure_metrics_server, traced
+from pdf_rendering import section_flowables
+from pdf_cache import PdfCache
 
 # OpenAI setup
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+client = get_openai_client(st.secrets["OPENAI_API_KEY"])
+transcription_backend = get_transcription_backend(client)
+ensure_metrics_server()
 
 st.set_page_config(page_title="🎤 Arztbrief aus Browser-Aufnahme", layout="centered")
 st.title("🎤 Arztbrief aus Browser-Aufnahme")
@@ -22,22 +26,22 @@ Ein strukturierter Arztbrief wird automatisch erstellt.
 """)
 
 # PDF-Erstellung ausgelagert
+@traced("pdf_render")
 def create_pdf_report(brief_text):
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=50, bottomMargin=50)
-    styles = getSampleStyleSheet()
     elements = []
-    for section in brief_text.split("\n\n"):
-        lines = section.strip().split("\n", 1)
-        if len(lines) == 2:
-            heading, content = lines
-            elements.append(Paragraph(f"<b>{heading}:</b>", styles["Heading4"]))
-            elements.append(Paragraph(content.strip().replace("\n", "<br/>"), styles["BodyText"]))
-            elements.append(Spacer(1, 12))
+    elements.extend(section_flowables(brief_text))
     doc.build(elements)
     buffer.seek(0)
     return buffer
 
+@st.cache_resource
+def get_pdf_cache():
+    return PdfCache()
+
+pdf_cache = get_pdf_cache()
+
 # HTML/JS Recorder
 components.html("""
 <script>
@@ -101,17 +105,8 @@ if js_response and not st.session_state.audio_base64:
     st.session_state.transcription_done = False
     audio_bytes = base64.b64decode(js_response.split(",")[1])
     st.audio(audio_bytes, format="audio/webm")
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as f:
-        f.write(audio_bytes)
-        f.flush()
-        with open(f.name, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="de"
-            )
-    os.remove(f.name)
-    st.session_state.transcription_text = transcript.text
+    transcript_text = transcription_backend.transcribe_bytes(audio_bytes)
+    st.session_state.transcription_text = transcript_text
     st.session_state.transcription_done = True
     st.write("📝 Transkriptionstext (Ausschnitt):", st.session_state.transcription_text[:300])
 
@@ -123,44 +118,36 @@ uploaded_file = st.file_uploader("📁 Oder lade eine Audiodatei hoch (MP3, WAV,
 if uploaded_file:
     st.success("📥 Datei erfolgreich hochgeladen.")
     st.session_state.transcription_done = False
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as f:
-        f.write(uploaded_file.read())
-        f.flush()
-        with open(f.name, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="de"
-            )
-    os.remove(f.name)
+    transcript_text = transcription_backend.transcribe_bytes(uploaded_file.getvalue())
     st.session_state.audio_base64 = None
-    st.session_state.transcription_text = transcript.text
+    st.session_state.transcription_text = transcript_text
     st.session_state.transcription_done = True
     st.audio(uploaded_file, format="audio/webm")
-    st.write("📝 Transkriptionstext (Ausschnitt):", transcript.text[:300])
+    st.write("📝 Transkriptionstext (Ausschnitt):", transcript_text[:300])
 
 # GPT Analyse + PDF
 if st.session_state.transcription_done:
     if st.button("🧠 Arztbrief generieren mit GPT"):
-        with st.spinner("💬 GPT erstellt den Arztbrief..."):
-            system_prompt = """
-            Du bist ein medizinischer Assistent, der aus Transkripten strukturierte Arztbriefe erstellt.
-            Gliedere in: Anamnese, Diagnose, Therapie, Aufklärung, Organisatorisches, Operationsplanung, Patientenwunsch.
-            Füge drei passende ICD-10-Codes unter Diagnose hinzu (Format: Bezeichnung → Code).
-            """
-            chat = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": st.session_state.transcription_text}
-                ],
-                temperature=0.3
-            )
-            report = chat.choices[0].message.content.strip()
-
-            st.subheader("📄 Arztbrief")
-            st.text_area("Arztbrief mit ICD-10-Codes", report, height=400)
-
-            pdf_buffer = create_pdf_report(report)
-            st.download_button("⬇️ PDF herunterladen", data=pdf_buffer, file_name="arztbrief.pdf", mime="application/pdf")
-            st.download_button("⬇️ Arztbrief als Textdatei", report, file_name="arztbrief.txt")
+        system_prompt = """
+        Du bist ein medizinischer Assistent, der aus Transkripten strukturierte Arztbriefe erstellt.
+        Gliedere in: Anamnese, Diagnose, Therapie, Aufklärung, Organisatorisches, Operationsplanung, Patientenwunsch.
+        Füge drei passende ICD-10-Codes unter Diagnose hinzu (Format: Bezeichnung → Code).
+        """
+        st.caption("💬 GPT erstellt den Arztbrief...")
+        generation_timings = {}
+        with st.container(border=True):
+            report = st.write_stream(stream_letter(
+                client,
+                build_messages(system_prompt, st.session_state.transcription_text),
+                timings=generation_timings
+            )).strip()
+        st.caption(format_timings(generation_timings))
+
+        st.subheader("📄 Arztbrief")
+        st.text_area("Arztbrief mit ICD-10-Codes", report, height=400)
+
+        # PDF erst beim Klick rendern; unveränderter Brief kommt beim nächsten Download aus dem Cache
+        pdf_key = pdf_cache.make_key(report)
+        st.download_button("⬇️ PDF herunterladen", data=pdf_cache.download_data(pdf_key, create_pdf_report, report),
+                           file_name="arztbrief.pdf", mime="application/pdf", on_click="ignore")
+        st.download_button("⬇️ Arztbrief als Textdatei", report, file_name="arztbrief.txt")
@@ -1,142 +1,82 @@
 
 import streamlit as st
 import openai
-import tempfile
 import os
 import re
-import pandas as pd
-from difflib import get_close_matches
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from transcription_cache import TranscriptionCache
+from openai_client import get_openai_client
+from icd_catalog import load_icd_catalog
+from transcription_backends import get_transcription_backend
+from letter_generation import (
+    STRUCTURED_PROMPT_SUFFIX, SYSTEM_PROMPT, format_timings, generate_structured_letter, stream_letter,
+    structured_letter_text
+)
+from metrics import ensure_metrics_server, record_usage, span, traced
+from pdf_cache import PdfCache
+from arztbrief_report import add_icd_codes, check_report_quality, create_pdf_report, validate_icd_candidates
+from pdf_rendering import logo_version
 
 # OpenAI Client
-client = openai.OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-
-# === SYSTEMPROMPT ===
-SYSTEM_PROMPT = """Du bist ein medizinischer Assistent, der aus Transkripten von Arzt-Patienten-Gesprächen strukturierte Arztbriefe erstellt.
-Gliedere den Brief in folgende Abschnitte:
-
-Anamnese, Diagnose, Therapie, Aufklärung, Organisatorisches, Operationsplanung, Patientenwunsch.
-
-Verwende eine sachliche, medizinisch korrekte Ausdrucksweise. Vermute keine Inhalte, die nicht im Text vorkommen."""
+client = get_openai_client(st.secrets["OPENAI_API_KEY"])
+transcription_backend = get_transcription_backend(client)
+ensure_metrics_server()
 
 @st.cache_resource
-def load_model():
-    return whisper.load_model("base")
+def load_icd10_mapping(filepath="icd10gm2025_codes.txt"):
+    return load_icd_catalog(filepath)
 
 @st.cache_resource
-def load_icd10_mapping(filepath="icd10gm2025_codes.txt"):
-    df = pd.read_csv(filepath, sep="|", header=None, dtype=str)
-    df.columns = ["Stufe", "ID", "Ebene", "Code", "Leer1", "Leer2", "Leer3", "Beschreibung"]
-    df = df[["Code", "Beschreibung"]].dropna()
-    icd_map = {row["Beschreibung"].lower(): row["Code"] for _, row in df.iterrows()}
-    return icd_map
+def get_transcription_cache():
+    return TranscriptionCache(cache_dir=os.environ.get("ARZTBRIEF_TRANSCRIPT_CACHE_DIR"))
 
 def transcribe_audio(file):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-        tmp.write(file.read())
-        tmp_path = tmp.name
-
-    with open(tmp_path, "rb") as audio_file:
-        transcript = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-            language="de"
-        )
-
-    return transcript.text
+    audio_bytes = file.getvalue()
+    cache = get_transcription_cache()
+    cache_key = cache.make_key(audio_bytes, model=transcription_backend.model_id, language="de")
+    cached_text = cache.get(cache_key)
+    if cached_text is not None:
+        return cached_text
+
+    text = transcription_backend.transcribe_bytes(audio_bytes)
+    cache.put(cache_key, text)
+    return text
     
-def generate_report_with_gpt(transcript):
+def generate_report_with_gpt(transcript, timings=None):
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": f"Hier ist das Gespräch:\n{transcript}"}
     ]
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0.3
-    )
-    return response.choices[0].message.content
+    return stream_letter(client, messages, model="gpt-4o", temperature=0.3, timings=timings)
+
+def generate_structured_report(transcript, timings=None):
+    # Brief und ICD-Kandidaten in einem Aufruf statt generate_report_with_gpt + extract_icds_via_gpt
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT + STRUCTURED_PROMPT_SUFFIX},
+        {"role": "user", "content": f"Hier ist das Gespräch:\n{transcript}"}
+    ]
+    return generate_structured_letter(client, messages, model="gpt-4o", temperature=0.3, timings=timings)
 
 def find_icd_codes_in_text(text, icd_map, threshold=0.85):
-    found = set()
-    words = set(text.lower().split())
-    for desc in icd_map:
-        tokens = set(desc.split())
-        if tokens & words:
-            found.add((desc.title(), icd_map[desc]))
-        else:
-            match = get_close_matches(desc, text.lower().split(), n=1, cutoff=threshold)
-            if match:
-                found.add((desc.title(), icd_map[desc]))
-    return list(found)
-
-def insert_multiple_icds_into_diagnosis(report_text, icd_map):
-    lines = report_text.splitlines()
-    new_lines = []
-    inside_diagnose = False
-    inserted = False
-    all_icds = find_icd_codes_in_text(report_text, icd_map)
-
-    for line in lines:
-        new_lines.append(line)
-        if line.strip().lower().startswith("diagnose"):
-            inside_diagnose = True
-        elif inside_diagnose and line.strip() == "":
-            inside_diagnose = False
-            if not inserted and all_icds:
-                new_lines.append("ICD-10-Codes:")
-                for term, code in all_icds:
-                    new_lines.append(f"- {term} → {code}")
-                inserted = True
-    return "\n".join(new_lines)
-
-def check_report_quality(report_text):
-    checks = []
-    if "Diagnose" not in report_text or "nicht dokumentiert" in report_text.split("Diagnose")[1][:100]:
-        checks.append("⚠️ Diagnose fehlt oder unklar.")
-    if "Therapie" not in report_text or "nicht dokumentiert" in report_text.split("Therapie")[1][:100]:
-        checks.append("⚠️ Therapieempfehlung nicht angegeben.")
-    if "Aufklärung" not in report_text:
-        checks.append("⚠️ Keine Aufklärung dokumentiert.")
-    if "Operationsplanung" not in report_text:
-        checks.append("ℹ️ Kein OP-Termin genannt.")
-    if "Zuweisung" not in report_text and "Blutbild" not in report_text:
-        checks.append("ℹ️ Keine organisatorischen Hinweise (z. B. Blutbild, Zuweisung).")
-    if not checks:
-        checks.append("✅ Bericht scheint vollständig und strukturiert zu sein.")
-    return checks
-
-def create_pdf_report(brief_text, logo_path=None):
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=50, bottomMargin=50)
-    styles = getSampleStyleSheet()
-    elements = []
-
-   import os
-
-if logo_path and os.path.exists(logo_path):
-    try:
-        img = Image(logo_path, width=150, height=50)
-        elements.append(img)
-        elements.append(Spacer(1, 20))
-    except Exception as e:
-        print(f"⚠️ Logo konnte nicht geladen werden: {e}")
-
-
-    for section in brief_text.split("\n\n"):
-        lines = section.strip().split("\n", 1)
-        if len(lines) == 2:
-            heading, content = lines
-            elements.append(Paragraph(f"<b>{heading}:</b>", styles["Heading4"]))
-            elements.append(Paragraph(content.strip().replace("\n", "<br/>"), styles["BodyText"]))
-            elements.append(Spacer(1, 12))
-
-    doc.build(elements)
-    buffer.seek(0)
-    return buffer
+    return icd_map.search(text, threshold=threshold)
+
+@st.cache_data(show_spinner=False)
+def match_icds_locally(report_text, catalog_version, _icd_map):
+    # Einmal pro Brief: Einfügen, Anzeige und Zusammenführung nutzen dasselbe Ergebnis.
+    # Der Index selbst wird nicht gehasht; catalog_version verhindert Treffer aus einem alten Katalog
+    return find_icd_codes_in_text(report_text, _icd_map)
+
+@traced("icd_insert")
+def insert_multiple_icds_into_diagnosis(report_text, icd_map, all_icds=None):
+    if all_icds is None:
+        all_icds = find_icd_codes_in_text(report_text, icd_map)
+    return add_icd_codes(report_text, all_icds)
+
+@st.cache_resource
+def get_pdf_cache():
+    return PdfCache()
+
+pdf_cache = get_pdf_cache()
 
 # === GPT-basierte ICD-Erkennung ===
 def extract_icds_via_gpt(text, max_codes=3):
@@ -152,14 +92,42 @@ def extract_icds_via_gpt(text, max_codes=3):
         {"role": "user", "content": text}
     ]
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0.0
-    )
+    with span("chat_completion", model="gpt-4o", input_size=len(text), purpose="icd_extraction") as attrs:
+        response = client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            temperature=0.0
+        )
+        record_usage(attrs, response.usage)
 
     return response.choices[0].message.content
 
+ICD_LINE_PATTERN = re.compile(r"\b([A-Z]\d{2}(?:\.\d{1,2})?)[!*+†]*\s*[:–-]\s*(.+)")
+
+def parse_gpt_icds(text):
+    suggestions = []
+    for line in text.splitlines():
+        match = ICD_LINE_PATTERN.search(line)
+        if match:
+            suggestions.append((match.group(2).strip(), match.group(1)))
+    return suggestions
+
+def merge_icd_suggestions(local_icds, gpt_icds, k=60):
+    # Reciprocal Rank Fusion: von beiden Quellen genannte Codes landen oben, Dubletten werden zusammengelegt
+    merged = {}
+    for source, suggestions in (("Wortbasiert", local_icds), ("GPT", gpt_icds)):
+        for rank, (term, code) in enumerate(suggestions):
+            code = code.upper().rstrip(".")
+            entry = merged.setdefault(code, {"code": code, "term": term, "score": 0.0, "sources": []})
+            if source not in entry["sources"]:
+                entry["score"] += 1 / (k + rank)
+                entry["sources"].append(source)
+    return sorted(merged.values(), key=lambda e: e["score"], reverse=True)
+
+@st.cache_resource
+def get_icd_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="icd")
+
 # === Streamlit UI ===
 st.set_page_config(page_title="Arztbrief aus Audio", layout="centered")
 st.title("🎤 Arztbrief aus Audioaufnahme")
@@ -178,10 +146,29 @@ if audio_file:
     st.subheader("📝 Transkript")
     st.text_area("Transkribierter Text", transkript, height=250)
 
+    structured_mode = st.toggle("⚡ Brief und ICD-Codes in einem GPT-Aufruf (JSON)", value=False)
+
     if st.button("🧠 Arztbrief generieren mit GPT"):
-        with st.spinner("💬 GPT analysiert das Gespräch…"):
-            report = generate_report_with_gpt(transkript)
-            report_with_icd = insert_multiple_icds_into_diagnosis(report, icd_map)
+        st.caption("💬 GPT analysiert das Gespräch…")
+        generation_timings = {}
+        gpt_future = None
+        if structured_mode:
+            with st.spinner("🧠 GPT schreibt Brief und ICD-Codes…"):
+                try:
+                    structured = generate_structured_report(transkript, timings=generation_timings)
+                except (openai.OpenAIError, ValueError) as e:
+                    st.error(f"❌ Strukturierte Generierung fehlgeschlagen: {e}")
+                    st.stop()
+            report = structured_letter_text(structured)
+            gpt_icds, rejected_codes = validate_icd_candidates(structured["icd_codes"], icd_map)
+        else:
+            with st.container(border=True):
+                report = st.write_stream(generate_report_with_gpt(transkript, timings=generation_timings))
+            # GPT-Kodierung sofort starten; lokale Suche, Regelprüfung und PDF laufen währenddessen
+            gpt_future = get_icd_executor().submit(extract_icds_via_gpt, report)
+        st.caption(format_timings(generation_timings))
+        local_icds = match_icds_locally(report, icd_map.version, icd_map)
+        report_with_icd = insert_multiple_icds_into_diagnosis(report, icd_map, all_icds=local_icds)
 
         st.subheader("📄 Generierter Arztbrief")
         st.text_area("Arztbrief mit ICD-10", report_with_icd, height=400)
@@ -197,16 +184,43 @@ if audio_file:
                 st.success(msg)
 
         st.subheader("📘 Gefundene ICD-10-Codes (Wortbasiert)")
-        codes = find_icd_codes_in_text(report_with_icd, icd_map)
-        for term, code in codes:
+        for term, code in local_icds:
             st.markdown(f"- **{term}** → `{code}`")
-
         st.subheader("🧠 GPT-gestützte ICD-10-Vorschläge")
-        gpt_icds = extract_icds_via_gpt(report_with_icd)
-        st.text_area("📋 GPT-Vorschläge", gpt_icds, height=150)
+        gpt_section = st.empty()
+        if gpt_future is not None:
+            gpt_section.caption("⏳ GPT kodiert den Brief…")
+        st.subheader("🏷️ ICD-10-Codes (zusammengeführt)")
+        merged_section = st.empty()
+        merged_section.caption("⏳ Wartet auf GPT-Vorschläge…")
 
         st.subheader("📄 PDF-Export")
         logo_path = "logo.png"
-        pdf_buffer = create_pdf_report(report_with_icd, logo_path=logo_path)
-        st.download_button("⬇️ PDF herunterladen", data=pdf_buffer, file_name="arztbrief.pdf", mime="application/pdf")
+        # PDF erst beim Klick rendern; unveränderter Brief kommt beim nächsten Download aus dem Cache
+        pdf_key = pdf_cache.make_key(report_with_icd, layout=logo_path, template_version=logo_version(logo_path))
+        st.download_button("⬇️ PDF herunterladen", data=pdf_cache.download_data(pdf_key, create_pdf_report, report_with_icd, logo_path=logo_path),
+                           file_name="arztbrief.pdf", mime="application/pdf", on_click="ignore")
         st.download_button("⬇️ Arztbrief als Textdatei", report_with_icd, file_name="arztbrief.txt")
+
+        if gpt_future is None:
+            with gpt_section.container():
+                for term, code in gpt_icds:
+                    st.markdown(f"- **{term}** → `{code}`")
+                if rejected_codes:
+                    st.warning(f"⚠️ Nicht im ICD-10-GM-Katalog, verworfen: {', '.join(rejected_codes)}")
+        else:
+            gpt_icds = []
+            try:
+                gpt_text = gpt_future.result()
+                if gpt_text is None:
+                    raise ValueError("leere Antwort")
+                gpt_section.text_area("📋 GPT-Vorschläge", gpt_text, height=150)
+                gpt_icds = parse_gpt_icds(gpt_text)
+            except Exception as e:
+                # Der Brief steht schon; bei jedem Fehler des Worker-Threads nur die wortbasierten Codes verwenden
+                gpt_icds = []
+                gpt_section.error(f"❌ GPT-Kodierung fehlgeschlagen, nur wortbasierte Codes: {type(e).__name__}: {e}")
+
+        with merged_section.container():
+            for entry in merge_icd_suggestions(local_icds, gpt_icds):
+                st.markdown(f"- **{entry['term']}** → `{entry['code']}` · {', '.join(entry['sources'])}")
@@ -1,131 +1,60 @@
 
 import streamlit as st
-import openai
-import tempfile
 import os
-import pandas as pd
-from difflib import get_close_matches
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
-from io import BytesIO
+from transcription_cache import TranscriptionCache
+from openai_client import get_openai_client
+from icd_catalog import load_icd_catalog
+from transcription_backends import get_transcription_backend
+from letter_generation import SYSTEM_PROMPT, stream_letter, format_timings
+from metrics import ensure_metrics_server, traced
+from pdf_cache import PdfCache
+from arztbrief_report import add_icd_codes, check_report_quality, create_pdf_report
+from pdf_rendering import logo_version
 
 # OpenAI Client
-client = openai.OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-
-SYSTEM_PROMPT = """Du bist ein medizinischer Assistent, der aus Transkripten von Arzt-Patienten-Gesprächen strukturierte Arztbriefe erstellt.
-Gliedere den Brief in folgende Abschnitte:
-
-Anamnese, Diagnose, Therapie, Aufklärung, Organisatorisches, Operationsplanung, Patientenwunsch.
-
-Verwende eine sachliche, medizinisch korrekte Ausdrucksweise. Vermute keine Inhalte, die nicht im Text vorkommen."""
+client = get_openai_client(st.secrets["OPENAI_API_KEY"])
+transcription_backend = get_transcription_backend(client)
+ensure_metrics_server()
 
 @st.cache_resource
 def load_icd10_mapping(filepath="icd10gm2025_codes.txt"):
-    df = pd.read_csv(filepath, sep="|", header=None, dtype=str)
-    df.columns = ["Stufe", "ID", "Ebene", "Code", "Leer1", "Leer2", "Leer3", "Beschreibung"]
-    df = df[["Code", "Beschreibung"]].dropna()
-    icd_map = {row["Beschreibung"].lower(): row["Code"] for _, row in df.iterrows()}
-    return icd_map
+    return load_icd_catalog(filepath)
+
+@st.cache_resource
+def get_transcription_cache():
+    return TranscriptionCache(cache_dir=os.environ.get("ARZTBRIEF_TRANSCRIPT_CACHE_DIR"))
 
 def transcribe_audio(file):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-        tmp.write(file.read())
-        tmp_path = tmp.name
-    with open(tmp_path, "rb") as audio_file:
-        transcript = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-            language="de"
-        )
-    return transcript.text
-
-def generate_report_with_gpt(transcript):
+    audio_bytes = file.getvalue()
+    cache = get_transcription_cache()
+    cache_key = cache.make_key(audio_bytes, model=transcription_backend.model_id, language="de")
+    cached_text = cache.get(cache_key)
+    if cached_text is not None:
+        return cached_text
+
+    text = transcription_backend.transcribe_bytes(audio_bytes)
+    cache.put(cache_key, text)
+    return text
+
+def generate_report_with_gpt(transcript, timings=None):
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": f"Hier ist das Gespräch:\n{transcript}"}
     ]
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0.3
-    )
-    return response.choices[0].message.content
+    return stream_letter(client, messages, model="gpt-4o", temperature=0.3, timings=timings)
 
 def find_icd_codes_in_text(text, icd_map, threshold=0.85, top_n=3):
-    found = []
-    text_words = set(text.lower().split())
-    for desc, code in icd_map.items():
-        desc_words = set(desc.lower().split())
-        if desc_words & text_words:
-            found.append((desc.title(), code))
-        else:
-            matches = get_close_matches(desc.lower(), text_words, n=1, cutoff=threshold)
-            if matches:
-                found.append((desc.title(), code))
-    return found[:top_n]
+    return icd_map.search(text, top_n=top_n, threshold=threshold)
 
+@traced("icd_insert")
 def insert_icds_into_diagnosis(report_text, icd_map):
-    lines = report_text.splitlines()
-    new_lines = []
-    inside_diagnose = False
-    inserted = False
-    top_icds = find_icd_codes_in_text(report_text, icd_map)
-
-    for line in lines:
-        new_lines.append(line)
-        if line.strip().lower().startswith("diagnose"):
-            inside_diagnose = True
-        elif inside_diagnose and line.strip() == "":
-            inside_diagnose = False
-            if not inserted and top_icds:
-                new_lines.append("ICD-10-Codes:")
-                for term, code in top_icds:
-                    new_lines.append(f"- {term} → {code}")
-                inserted = True
-    return "\n".join(new_lines)
-
-def check_report_quality(report_text):
-    checks = []
-    if "Diagnose" not in report_text or "nicht dokumentiert" in report_text.split("Diagnose")[1][:100]:
-        checks.append("⚠️ Diagnose fehlt oder unklar.")
-    if "Therapie" not in report_text or "nicht dokumentiert" in report_text.split("Therapie")[1][:100]:
-        checks.append("⚠️ Therapieempfehlung nicht angegeben.")
-    if "Aufklärung" not in report_text:
-        checks.append("⚠️ Keine Aufklärung dokumentiert.")
-    if "Operationsplanung" not in report_text:
-        checks.append("ℹ️ Kein OP-Termin genannt.")
-    if "Zuweisung" not in report_text and "Blutbild" not in report_text:
-        checks.append("ℹ️ Keine organisatorischen Hinweise (z. B. Blutbild, Zuweisung).")
-    if not checks:
-        checks.append("✅ Bericht scheint vollständig und strukturiert zu sein.")
-    return checks
-
-def create_pdf_report(brief_text, logo_path=None):
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=50, bottomMargin=50)
-    styles = getSampleStyleSheet()
-    elements = []
-
-    if logo_path and os.path.exists(logo_path):
-        try:
-            img = Image(logo_path, width=150, height=50)
-            elements.append(img)
-            elements.append(Spacer(1, 20))
-        except Exception as e:
-            print(f"⚠️ Logo konnte nicht geladen werden: {e}")
-
-    for section in brief_text.split("\n\n"):
-        lines = section.strip().split("\n", 1)
-        if len(lines) == 2:
-            heading, content = lines
-            elements.append(Paragraph(f"<b>{heading}:</b>", styles["Heading4"]))
-            elements.append(Paragraph(content.strip().replace("\n", "<br/>"), styles["BodyText"]))
-            elements.append(Spacer(1, 12))
-
-    doc.build(elements)
-    buffer.seek(0)
-    return buffer
+    return add_icd_codes(report_text, find_icd_codes_in_text(report_text, icd_map))
+
+@st.cache_resource
+def get_pdf_cache():
+    return PdfCache()
+
+pdf_cache = get_pdf_cache()
 
 # === Streamlit UI ===
 st.set_page_config(page_title="Arztbrief aus Audio", layout="centered")
@@ -146,9 +75,12 @@ if audio_file:
     st.text_area("Transkribierter Text", transkript, height=250)
 
     if st.button("🧠 Arztbrief generieren mit GPT"):
-        with st.spinner("💬 GPT analysiert das Gespräch…"):
-            report = generate_report_with_gpt(transkript)
-            report_with_icd = insert_icds_into_diagnosis(report, icd_map)
+        st.caption("💬 GPT analysiert das Gespräch…")
+        generation_timings = {}
+        with st.container(border=True):
+            report = st.write_stream(generate_report_with_gpt(transkript, timings=generation_timings))
+        st.caption(format_timings(generation_timings))
+        report_with_icd = insert_icds_into_diagnosis(report, icd_map)
 
         st.subheader("📄 Generierter Arztbrief")
         st.text_area("Arztbrief mit ICD-10", report_with_icd, height=400)
@@ -170,6 +102,8 @@ if audio_file:
 
         st.subheader("📄 PDF-Export")
         logo_path = "logo.png"
-        pdf_buffer = create_pdf_report(report_with_icd, logo_path=logo_path)
-        st.download_button("⬇️ PDF herunterladen", data=pdf_buffer, file_name="arztbrief.pdf", mime="application/pdf")
+        # PDF erst beim Klick rendern; unveränderter Brief kommt beim nächsten Download aus dem Cache
+        pdf_key = pdf_cache.make_key(report_with_icd, layout=logo_path, template_version=logo_version(logo_path))
+        st.download_button("⬇️ PDF herunterladen", data=pdf_cache.download_data(pdf_key, create_pdf_report, report_with_icd, logo_path=logo_path),
+                           file_name="arztbrief.pdf", mime="application/pdf", on_click="ignore")
         st.download_button("⬇️ Arztbrief als Textdatei", report_with_icd, file_name="arztbrief.txt")
@@ -0,0 +1,94 @@
+import os
+from io import BytesIO
+from reportlab.lib.pagesizes import A4
+from reportlab.platypus import SimpleDocTemplate, Spacer
+
+from letter_sections import as_letter
+from metrics import traced
+from pdf_rendering import logo_flowable, section_flowables
+
+# Streamlit-unabhängige Fassung der Arztbrief-Schritte (ICD-Ergänzung, Regelprüfung, PDF),
+# damit Batch-Läufe und Pipeline sie ohne UI verwenden können.
+
+
+@traced("icd_lookup")
+def find_icd_codes_in_text(text, icd_map, threshold=0.85, top_n=3):
+    return icd_map.search(text, top_n=top_n, threshold=threshold)
+
+
+def add_icd_codes(report, icds):
+    """ICD-Liste direkt nach dem Inhalt des Diagnose-Abschnitts einfügen; der übrige Text bleibt unverändert."""
+    letter = as_letter(report)
+    diagnose = letter.find("diagnose")
+    if not icds or diagnose is None:
+        return letter.source
+    extra = ["ICD-10-Codes:"] + [f"- {term} → {code}" for term, code in icds]
+    return letter.insert_after(diagnose, extra)
+
+
+@traced("icd_insert")
+def insert_icds_into_diagnosis(report_text, icd_map, top_n=3):
+    return add_icd_codes(report_text, find_icd_codes_in_text(report_text, icd_map, top_n=top_n))
+
+
+def validate_icd_candidates(candidates, icd_map):
+    """Vom Modell vorgeschlagene Codes gegen den ICD-10-GM-Katalog prüfen.
+
+    Liefert ([(Bezeichnung, Code)], [unbekannte Codes]); die Bezeichnung kommt aus dem Katalog.
+    """
+    valid, rejected, seen = [], [], set()
+    for candidate in candidates:
+        match = icd_map.lookup_code(candidate["code"])
+        if match is None:
+            rejected.append(candidate["code"])
+            continue
+        code, term = match
+        if code not in seen:
+            seen.add(code)
+            valid.append((term, code))
+    return valid, rejected
+
+
+def _undocumented(section):
+    return section is None or not section.content or "nicht dokumentiert" in section.content[:100]
+
+
+@traced("quality_check")
+def check_report_quality(report):
+    letter = as_letter(report)
+    report_text = letter.source
+    checks = []
+    if _undocumented(letter.find("diagnose")):
+        checks.append("⚠️ Diagnose fehlt oder unklar.")
+    if _undocumented(letter.find("therapie")):
+        checks.append("⚠️ Therapieempfehlung nicht angegeben.")
+    if letter.find("aufklärung") is None:
+        checks.append("⚠️ Keine Aufklärung dokumentiert.")
+    if letter.find("operationsplanung") is None:
+        checks.append("ℹ️ Kein OP-Termin genannt.")
+    if "Zuweisung" not in report_text and "Blutbild" not in report_text:
+        checks.append("ℹ️ Keine organisatorischen Hinweise (z. B. Blutbild, Zuweisung).")
+    if not checks:
+        checks.append("✅ Bericht scheint vollständig und strukturiert zu sein.")
+    return checks
+
+
+@traced("pdf_render")
+def create_pdf_report(brief_text, logo_path=None):
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=50, bottomMargin=50)
+    elements = []
+
+    if logo_path and os.path.exists(logo_path):
+        try:
+            img = logo_flowable(logo_path, width=150, height=50)
+            elements.append(img)
+            elements.append(Spacer(1, 20))
+        except Exception as e:
+            print(f"⚠️ Logo konnte nicht geladen werden: {e}")
+
+    elements.extend(section_flowables(brief_text))
+
+    doc.build(elements)
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,299 @@
+import contextvars
+import os
+import re
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from pydub import AudioSegment
+from pydub.silence import detect_silence
+
+from metrics import span
+
+# whisper-1 akzeptiert höchstens 25 MB pro Request
+WHISPER_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+# Ab dieser Grösse lohnt sich das Aufteilen auch unterhalb des Limits (ca. 5 min komprimierte Sprache)
+CHUNKING_MIN_BYTES = 5 * 1024 * 1024
+
+# Von whisper-1 direkt akzeptierte Container
+WHISPER_FORMATS = {"flac", "m4a", "mp3", "mp4", "mpeg", "mpga", "oga", "ogg", "wav", "webm"}
+# Unkomprimiertes WAV über dieser Grösse wird trotzdem verkleinert, um Upload-Zeit zu sparen
+WAV_TRANSCODE_MIN_BYTES = 1024 * 1024
+
+# MP4/M4A haben den moov-Atom oft am Dateiende; ffmpeg braucht dafür eine seekbare Eingabe
+SEEKABLE_INPUT_FORMATS = {"m4a", "mp4"}
+
+SPEECH_SAMPLE_RATE = 16000
+PCM_INPUT_ARGS = ["-f", "s16le", "-ar", str(SPEECH_SAMPLE_RATE), "-ac", "1", "-i", "pipe:0"]
+PCM_OUTPUT_ARGS = ["-vn", "-ac", "1", "-ar", str(SPEECH_SAMPLE_RATE), "-f", "s16le"]
+OPUS_OUTPUT_ARGS = ["-vn", "-ac", "1", "-ar", str(SPEECH_SAMPLE_RATE), "-c:a", "libopus", "-b:a", "24k", "-f", "ogg"]
+
+CHUNK_MS = 5 * 60 * 1000
+OVERLAP_MS = 2000
+SILENCE_SEARCH_MS = 30 * 1000
+
+
+def sniff_format(audio_bytes):
+    """Container anhand der Magic Bytes erkennen, ohne die Datei zu dekodieren."""
+    head = audio_bytes[:64]
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm" if b"webm" in head else "mkv"
+    if head[4:8] == b"ftyp":
+        return "m4a" if head[8:11] in (b"M4A", b"M4B") else "mp4"
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return "mp3"
+    return None
+
+
+@contextmanager
+def ffmpeg_input(audio_bytes):
+    """Eingabe-Argumente für ffmpeg: stdin-Pipe, nur für MP4/M4A eine Spill-Datei.
+
+    Die Spill-Datei wird in jedem Fall wieder gelöscht, auch wenn ffmpeg fehlschlägt.
+    """
+    fmt = sniff_format(audio_bytes)
+    if fmt not in SEEKABLE_INPUT_FORMATS:
+        yield ["-i", "pipe:0"], audio_bytes
+        return
+
+    fd, spill_path = tempfile.mkstemp(prefix="arztbrief_", suffix=f".{fmt}")
+    try:
+        with span("temp_write", input_size=len(audio_bytes)), os.fdopen(fd, "wb") as spill:
+            spill.write(audio_bytes)
+        yield ["-i", spill_path], None
+    finally:
+        try:
+            os.remove(spill_path)
+        except FileNotFoundError:
+            pass
+
+
+def run_ffmpeg(audio_bytes, output_args, input_args=None):
+    if input_args is not None:
+        return _run_ffmpeg(input_args, audio_bytes, output_args)
+    with ffmpeg_input(audio_bytes) as (spill_input_args, stdin_data):
+        return _run_ffmpeg(spill_input_args, stdin_data, output_args)
+
+
+def _run_ffmpeg(input_args, stdin_data, output_args):
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", *input_args, *output_args, "pipe:1"]
+    with span("ffmpeg", input_size=len(stdin_data) if stdin_data is not None else None) as attrs:
+        if stdin_data is None:
+            result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, check=True)
+        else:
+            result = subprocess.run(command, input=stdin_data, capture_output=True, check=True)
+        attrs["output_size"] = len(result.stdout)
+    return result.stdout
+
+
+def transcode_for_speech(audio_bytes):
+    """Beliebiges Audio nach Ogg/Opus, 16 kHz mono (ca. 180 kB pro Minute)."""
+    return run_ffmpeg(audio_bytes, OPUS_OUTPUT_ARGS)
+
+
+def decode_for_speech(audio_bytes):
+    return pcm_to_segment(run_ffmpeg(audio_bytes, PCM_OUTPUT_ARGS))
+
+
+class StreamingDecoder:
+    """Ein ffmpeg-Prozess pro Aufnahme, der fortlaufend angehängte Bytes zu 16-kHz-PCM dekodiert.
+
+    Jedes Byte wird nur einmal an ffmpeg übergeben; `take()` liefert das seit dem
+    letzten Aufruf neu dekodierte PCM. Für Container, die ffmpeg aus einer Pipe
+    lesen kann (WebM/Ogg aus dem Browser-Recorder).
+    """
+
+    def __init__(self):
+        self._process = subprocess.Popen(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0", *PCM_OUTPUT_ARGS, "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+        self._pcm = bytearray()
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, name="ffmpeg-stream-reader", daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        # stdout laufend leeren, damit ffmpeg beim Schreiben nie blockiert
+        for block in iter(lambda: self._process.stdout.read1(64 * 1024), b""):
+            with self._lock:
+                self._pcm += block
+
+    def feed(self, data):
+        """Neue Container-Bytes anhängen; wirft OSError, wenn ffmpeg nicht mehr läuft."""
+        with span("ffmpeg_stream", input_size=len(data)):
+            self._process.stdin.write(data)
+            self._process.stdin.flush()
+
+    def take(self):
+        with self._lock:
+            pcm = bytes(self._pcm)
+            self._pcm.clear()
+        return pcm
+
+    def finish(self, timeout=60):
+        """Eingabe schliessen und den Rest dekodieren; CalledProcessError bei Dekodierfehler."""
+        self._process.stdin.close()
+        returncode = self._process.wait(timeout)
+        self._reader.join()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self._process.args)
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        for pipe in (self._process.stdin, self._process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+
+def pcm_to_segment(pcm):
+    return AudioSegment(data=pcm, sample_width=2, frame_rate=SPEECH_SAMPLE_RATE, channels=1)
+
+
+def normalize_audio(audio_bytes):
+    """Gibt ein (Dateiname, Bytes)-Tupel zurück, das whisper-1 ohne Fehlversuch annimmt.
+
+    Transkodiert wird nur, wenn der Container unbekannt ist, das Upload-Limit
+    überschritten wird oder unkomprimiertes WAV unnötig gross ist.
+    """
+    fmt = sniff_format(audio_bytes)
+    too_large = len(audio_bytes) > WHISPER_MAX_UPLOAD_BYTES
+    bulky_wav = fmt == "wav" and len(audio_bytes) > WAV_TRANSCODE_MIN_BYTES
+    if fmt in WHISPER_FORMATS and not too_large and not bulky_wav:
+        return (f"audio.{fmt}", audio_bytes)
+    return ("audio.ogg", transcode_for_speech(audio_bytes))
+
+
+def needs_chunking(audio_bytes):
+    return len(audio_bytes) > CHUNKING_MIN_BYTES
+
+
+def nearest_pause(audio, target_ms, search_ms=SILENCE_SEARCH_MS, min_silence_len=500, silence_thresh=None):
+    """Mitte der Sprechpause, die `target_ms` am nächsten liegt (oder `target_ms` selbst)."""
+    if silence_thresh is None:
+        silence_thresh = audio.dBFS - 16
+    window_start = max(0, target_ms - search_ms)
+    window = audio[window_start:target_ms + search_ms]
+    pauses = detect_silence(window, min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=10)
+    if not pauses:
+        return target_ms
+    midpoints = [window_start + (start + end) // 2 for start, end in pauses]
+    return min(midpoints, key=lambda m: abs(m - target_ms))
+
+
+def find_cut_points(audio, chunk_ms=CHUNK_MS, search_ms=SILENCE_SEARCH_MS, min_silence_len=500):
+    """Schnittpunkte ungefähr alle `chunk_ms`, jeweils in die nächstgelegene Sprechpause verschoben.
+
+    Gesucht wird nur in einem Fenster um jede Zielposition, nicht in der ganzen Aufnahme.
+    """
+    silence_thresh = audio.dBFS - 16
+    cuts = []
+    target = chunk_ms
+    while target < len(audio) - chunk_ms // 4:
+        cut = nearest_pause(audio, target, search_ms=search_ms, min_silence_len=min_silence_len,
+                            silence_thresh=silence_thresh)
+        cuts.append(cut)
+        target = cut + chunk_ms
+    return cuts
+
+
+def split_with_overlap(audio, chunk_ms=CHUNK_MS, overlap_ms=OVERLAP_MS):
+    bounds = [0] + find_cut_points(audio, chunk_ms=chunk_ms) + [len(audio)]
+    return [
+        audio[max(0, start - overlap_ms):min(len(audio), end + overlap_ms)]
+        for start, end in zip(bounds, bounds[1:])
+    ]
+
+
+def export_chunk(segment, index):
+    return (f"chunk_{index:03d}.ogg", run_ffmpeg(segment.raw_data, OPUS_OUTPUT_ARGS, input_args=PCM_INPUT_ARGS))
+
+
+def _normalize_word(word):
+    return re.sub(r"\W", "", word.lower())
+
+
+def stitch_transcripts(texts, max_overlap_words=40, min_overlap_words=2):
+    """Fügt Teil-Transkripte zusammen und entfernt den doppelt transkribierten Überlappungsbereich."""
+    result = []
+    for text in texts:
+        words = text.split()
+        if result and words:
+            tail = [_normalize_word(w) for w in result[-max_overlap_words:]]
+            head = [_normalize_word(w) for w in words[:max_overlap_words]]
+            overlap = 0
+            # Einzelne gleiche Wörter ("und", "die") an der Nahtstelle sind meist Zufall
+            for size in range(min(len(tail), len(head)), min_overlap_words - 1, -1):
+                if tail[-size:] == head[:size]:
+                    overlap = size
+                    break
+            words = words[overlap:]
+        result.extend(words)
+    return " ".join(result)
+
+
+def chunk_segments(audio_bytes, chunk_ms=CHUNK_MS, overlap_ms=OVERLAP_MS):
+    return split_with_overlap(decode_for_speech(audio_bytes), chunk_ms=chunk_ms, overlap_ms=overlap_ms)
+
+
+def chunk_files(audio_bytes, chunk_ms=CHUNK_MS, overlap_ms=OVERLAP_MS):
+    chunks = chunk_segments(audio_bytes, chunk_ms=chunk_ms, overlap_ms=overlap_ms)
+    return [export_chunk(chunk, i) for i, chunk in enumerate(chunks)]
+
+
+def prepare_upload_files(audio_bytes):
+    """Upload-fertige (Dateiname, Bytes)-Tupel: eines für kurze Aufnahmen, sonst ein Tupel pro Abschnitt."""
+    if needs_chunking(audio_bytes):
+        return chunk_files(audio_bytes)
+    return [normalize_audio(audio_bytes)]
+
+
+def transcribe_chunked(audio_bytes, transcribe, max_workers=4, chunk_ms=CHUNK_MS, overlap_ms=OVERLAP_MS):
+    """Lange Aufnahme in Pausen aufteilen, Teile parallel transkribieren, Text zusammenfügen.
+
+    `transcribe` erhält ein (Dateiname, Bytes)-Tupel und gibt den Text zurück. Jeder
+    Abschnitt wird erst im Worker nach Opus kodiert, sodass Kodieren und Hochladen
+    verschiedener Abschnitte sich überlappen und der erste Request sofort startet.
+    """
+    segments = chunk_segments(audio_bytes, chunk_ms=chunk_ms, overlap_ms=overlap_ms)
+
+    def encode_and_transcribe(index):
+        return transcribe(export_chunk(segments[index], index))
+
+    if len(segments) == 1:
+        return encode_and_transcribe(0)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(segments))) as pool:
+        # Kontext pro Abschnitt kopieren, damit die Trace-ID der Anfrage in den Metriken erhalten bleibt
+        contexts = [contextvars.copy_context() for _ in segments]
+        texts = list(pool.map(lambda context, index: context.run(encode_and_transcribe, index),
+                              contexts, range(len(segments))))
+    return stitch_transcripts(texts)
+
+
+def whisper_transcriber(client, model="whisper-1", language="de"):
+    def transcribe(file):
+        with span("whisper_request", input_size=len(file[1]), model=model) as attrs:
+            text = client.audio.transcriptions.create(model=model, file=file, language=language).text
+            attrs["output_size"] = len(text)
+        return text
+    return transcribe
+
+
+def transcribe_audio_bytes(client, audio_bytes, model="whisper-1", language="de", max_workers=4):
+    transcribe = whisper_transcriber(client, model=model, language=language)
+    if needs_chunking(audio_bytes):
+        return transcribe_chunked(audio_bytes, transcribe, max_workers=max_workers)
+    return transcribe(normalize_audio(audio_bytes))
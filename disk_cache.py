@@ -0,0 +1,129 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class DiskLruCache:
+    """In-Memory-LRU mit optionaler Ablage auf Disk und optionaler TTL.
+
+    Gemeinsame Grundlage von `TranscriptionCache` und `GenerationCache`. Einträge
+    liegen auf Disk als JSON (`{"value": ..., "created": ...}`), geschrieben über
+    eine eindeutige Temp-Datei und `os.replace`. Die Disk-Ablage wird nach
+    Änderungszeit verdrängt; Lesen aktualisiert sie, damit das LRU-artig bleibt.
+    """
+
+    suffix = ".json"
+
+    def __init__(self, max_entries=128, cache_dir=None, max_disk_bytes=50 * 1024 * 1024, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._expired(entry):
+                    del self._memory[key]
+                    return None
+                self._memory.move_to_end(key)
+                return entry["value"]
+
+        entry = self._read_disk(key)
+        if entry is None:
+            return None
+        self._remember(key, entry)
+        return entry["value"]
+
+    def put(self, key, value):
+        entry = {"value": value, "created": time.time()}
+        self._remember(key, entry)
+        self._write_disk(key, entry)
+
+    def _expired(self, entry):
+        return self.ttl_seconds is not None and time.time() - entry["created"] > self.ttl_seconds
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}{self.suffix}")
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or "value" not in entry or "created" not in entry:
+            return None
+        if self._expired(entry):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        # Zugriffszeit aktualisieren, damit die Verdrängung LRU-artig bleibt
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def _write_disk(self, key, entry):
+        if not self.cache_dir:
+            return
+        # Eindeutige Temp-Datei: mehrere Threads eines Prozesses dürfen denselben Schlüssel schreiben
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._disk_path(key))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        # Älteste zuerst; seit der TTL nicht mehr gelesene Einträge sind sicher abgelaufen und fallen mit heraus
+        cutoff = time.time() - self.ttl_seconds if self.ttl_seconds is not None else None
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_disk_bytes and (cutoff is None or mtime >= cutoff):
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
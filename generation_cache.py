@@ -0,0 +1,33 @@
+import hashlib
+import json
+
+from disk_cache import DiskLruCache
+from openai_client import LLM_BASE_URL, resolve_chat_model
+
+
+class GenerationCache(DiskLruCache):
+    """Cache für GPT-Arztbriefe mit TTL, In-Memory-LRU und optionaler Ablage auf Disk.
+
+    Schlüssel ist der SHA-256 über Systemprompt, Transkript, Modell und Temperatur.
+    Das Modell geht so ein, wie es tatsächlich angefragt wird (`resolve_chat_model`,
+    samt ARZTBRIEF_LLM_BASE_URL); ein Brief von OpenAI gilt nicht für ein lokales Modell.
+    Ein Reload oder versehentlicher Doppelklick liefert denselben Brief sofort und
+    ohne API-Kosten; "Neu generieren" umgeht den Cache über `get_or_generate(..., refresh=True)`.
+    """
+
+    def __init__(self, max_entries=64, ttl_seconds=24 * 3600, cache_dir=None, max_disk_bytes=20 * 1024 * 1024):
+        super().__init__(max_entries=max_entries, cache_dir=cache_dir, max_disk_bytes=max_disk_bytes,
+                         ttl_seconds=ttl_seconds)
+
+    @staticmethod
+    def make_key(system_prompt, transcript, model="gpt-4o", temperature=0.3):
+        payload = json.dumps([system_prompt, transcript, LLM_BASE_URL, resolve_chat_model(model), temperature],
+                             ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_or_generate(self, key, generate, refresh=False):
+        text = None if refresh else self.get(key)
+        if text is None:
+            text = generate()
+            self.put(key, text)
+        return text
@@ -0,0 +1,158 @@
+import argparse
+import csv
+import marshal
+import os
+import sqlite3
+import sys
+import time
+
+from icd_index import IcdIndex
+
+CATALOG_VERSION = 1
+# marshal-Blobs sind nur innerhalb einer Python-Version lesbar
+MARSHAL_VERSION = "{}.{}".format(*sys.version_info[:2])
+# Optional: kompilierte Kataloge hier statt neben der Quelldatei ablegen (z. B. bei schreibgeschütztem Deploy)
+CATALOG_DIR = os.environ.get("ARZTBRIEF_ICD_CATALOG_DIR")
+
+# Spalten von icd10gm2025_codes.txt (pipe-getrennt, ohne Kopfzeile)
+COLUMNS = ["Stufe", "ID", "Ebene", "Code", "Leer1", "Leer2", "Leer3", "Beschreibung"]
+
+
+def default_catalog_path(filepath):
+    base = os.path.splitext(filepath)[0]
+    if CATALOG_DIR:
+        return os.path.join(CATALOG_DIR, os.path.basename(base) + ".sqlite")
+    return base + ".sqlite"
+
+
+def parse_icd10_codes(filepath):
+    icd_map = {}
+    levels = {}
+    code_col = COLUMNS.index("Code")
+    level_col = COLUMNS.index("Ebene")
+    desc_col = COLUMNS.index("Beschreibung")
+    with open(filepath, encoding="utf-8", newline="") as f:
+        for row in csv.reader(f, delimiter="|"):
+            if len(row) <= desc_col:
+                continue
+            code, desc = row[code_col].strip(), row[desc_col].strip()
+            if not code or not desc:
+                continue
+            icd_map[desc.lower()] = code
+            levels[desc.lower()] = row[level_col].strip()
+    return icd_map, levels
+
+
+def _source_signature(filepath):
+    stat = os.stat(filepath)
+    return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def compile_catalog(filepath, catalog_path=None):
+    catalog_path = catalog_path or default_catalog_path(filepath)
+    icd_map, levels = parse_icd10_codes(filepath)
+    index = IcdIndex(icd_map, levels=levels)
+    write_catalog(catalog_path, filepath, icd_map, levels, index)
+    return index
+
+
+def write_catalog(catalog_path, filepath, icd_map, levels, index):
+    """Schreibt den Katalog atomar; wirft OSError/sqlite3.Error, wenn das Ziel nicht beschreibbar ist."""
+    tmp_path = f"{catalog_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE codes (description TEXT PRIMARY KEY, code TEXT NOT NULL, level TEXT)")
+            conn.execute("CREATE INDEX codes_code ON codes (code)")
+            conn.execute("CREATE TABLE blobs (name TEXT PRIMARY KEY, data BLOB)")
+            conn.executemany(
+                "INSERT INTO meta VALUES (?, ?)",
+                [
+                    ("version", str(CATALOG_VERSION)),
+                    ("marshal", MARSHAL_VERSION),
+                    ("source", _source_signature(filepath)),
+                ],
+            )
+            conn.executemany(
+                "INSERT INTO codes VALUES (?, ?, ?)",
+                [(desc, code, levels.get(desc)) for desc, code in icd_map.items()],
+            )
+            # Komplettes Mapping und Suchindex als marshal-Blobs: ein Lesezugriff statt 16k Zeilen
+            conn.executemany(
+                "INSERT INTO blobs VALUES (?, ?)",
+                [
+                    ("icd_map", marshal.dumps(icd_map)),
+                    ("levels", marshal.dumps(levels)),
+                    ("index", marshal.dumps(index.to_state())),
+                ],
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp_path, catalog_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_catalog(catalog_path, source_path=None):
+    """Lädt einen kompilierten Katalog; None, wenn er fehlt, veraltet oder nicht lesbar ist."""
+    if not os.path.exists(catalog_path):
+        return None
+    try:
+        conn = sqlite3.connect(f"file:{catalog_path}?mode=ro", uri=True)
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            if meta.get("version") != str(CATALOG_VERSION) or meta.get("marshal") != MARSHAL_VERSION:
+                return None
+            if source_path and os.path.exists(source_path) and meta.get("source") != _source_signature(source_path):
+                return None
+            blobs = dict(conn.execute("SELECT name, data FROM blobs"))
+        finally:
+            conn.close()
+        return IcdIndex.from_state(
+            marshal.loads(blobs["icd_map"]),
+            marshal.loads(blobs["index"]),
+            levels=marshal.loads(blobs["levels"]),
+        )
+    except (sqlite3.Error, KeyError, ValueError, EOFError, TypeError):
+        # Beschädigte oder fremde Blobs: wie ein veralteter Katalog behandeln und neu kompilieren
+        return None
+
+
+def load_icd_catalog(filepath="icd10gm2025_codes.txt", catalog_path=None):
+    catalog_path = catalog_path or default_catalog_path(filepath)
+    index = load_catalog(catalog_path, source_path=filepath)
+    if index is not None:
+        return index
+    icd_map, levels = parse_icd10_codes(filepath)
+    index = IcdIndex(icd_map, levels=levels)
+    try:
+        os.makedirs(os.path.dirname(catalog_path) or ".", exist_ok=True)
+        write_catalog(catalog_path, filepath, icd_map, levels, index)
+    except (OSError, sqlite3.Error):
+        # Schreibgeschütztes Verzeichnis: Katalog nur im Speicher verwenden
+        pass
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ICD-10-GM-Katalog einmalig in eine SQLite-Datei kompilieren.")
+    parser.add_argument("source", nargs="?", default="icd10gm2025_codes.txt")
+    parser.add_argument("-o", "--output", help="Zieldatei (Standard: <source>.sqlite)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = compile_catalog(args.source, args.output)
+    print(f"{len(index)} ICD-Einträge kompiliert in {time.perf_counter() - start:.2f}s "
+          f"→ {args.output or default_catalog_path(args.source)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import hashlib
+import math
+import re
+from collections import defaultdict
+from functools import cached_property
+
+TOKEN_PATTERN = re.compile(r"\w+")
+CODE_NOISE = re.compile(r"[^A-Z0-9]")
+UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+
+def normalize(text):
+    return text.lower().translate(UMLAUTS)
+
+
+# Füllwörter, die in fast jeder ICD-Bezeichnung vorkommen und nichts über die Diagnose aussagen
+STOPWORDS = {normalize(w) for w in (
+    "und", "oder", "der", "die", "das", "des", "dem", "den", "ein", "eine", "einer", "eines",
+    "mit", "ohne", "bei", "durch", "als", "auf", "aus", "nach", "von", "vom", "zur", "zum",
+    "im", "in", "an", "am", "nicht", "näher", "bezeichnet", "sonstige", "sonstiger", "sonstiges",
+    "nnb", "sowie", "andere", "anderen", "anderer", "klassifiziert", "teil", "art",
+)}
+
+
+def tokenize(text):
+    return [t for t in TOKEN_PATTERN.findall(normalize(text)) if len(t) > 2 and t not in STOPWORDS]
+
+
+def normalize_code(code):
+    # "j20.9", "J20.9!" und "J209" bezeichnen denselben Code
+    return CODE_NOISE.sub("", code.upper())
+
+
+def trigrams(token):
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class IcdIndex(dict):
+    """ICD-10-GM-Mapping (Beschreibung → Code) mit invertiertem Token-Index.
+
+    Verhält sich wie das bisherige `icd_map`-Dict, sodass bestehender Code weiter
+    funktioniert, beantwortet Suchanfragen aber nur über Codes, die mit dem
+    Bericht mindestens ein (unscharf passendes) Token teilen. Unscharfe Treffer
+    laufen über einen Trigramm-Index des Vokabulars, die Kosten wachsen also mit
+    der Zahl der Wörter im Bericht und nicht mit der Grösse des Katalogs.
+    """
+
+    STATE_FIELDS = ("desc_weight", "token_index", "idf", "token_trigrams", "trigram_index")
+
+    def __init__(self, icd_map, levels=None):
+        super().__init__(icd_map)
+        self.levels = levels or {}
+        self.token_index = defaultdict(list)
+        desc_tokens = {}
+        for desc in self:
+            tokens = set(tokenize(desc))
+            desc_tokens[desc] = tokens
+            for token in tokens:
+                self.token_index[token].append(desc)
+        self.token_index = dict(self.token_index)
+
+        total = max(len(self), 1)
+        self.idf = {token: math.log(1 + total / len(descs)) for token, descs in self.token_index.items()}
+        self.desc_weight = {desc: sum(self.idf[t] for t in tokens) for desc, tokens in desc_tokens.items()}
+
+        self.token_trigrams = {}
+        self.trigram_index = defaultdict(list)
+        for token in self.token_index:
+            grams = trigrams(token)
+            self.token_trigrams[token] = grams
+            for gram in grams:
+                self.trigram_index[gram].append(token)
+        self.trigram_index = dict(self.trigram_index)
+        self._fuzzy_memo = {}
+
+    def to_state(self):
+        return {field: getattr(self, field) for field in self.STATE_FIELDS}
+
+    @classmethod
+    def from_state(cls, icd_map, state, levels=None):
+        # Vorberechneten Index übernehmen, ohne Tokenisierung und Trigramme neu aufzubauen
+        index = cls.__new__(cls)
+        dict.__init__(index, icd_map)
+        index.levels = levels or {}
+        for field in cls.STATE_FIELDS:
+            setattr(index, field, state[field])
+        index._fuzzy_memo = {}
+        return index
+
+    @cached_property
+    def version(self):
+        """Inhalts-Hash des Katalogs, z. B. als Cache-Schlüssel anstelle des (nicht hashbaren) Index."""
+        payload = "\n".join(f"{desc}\0{code}" for desc, code in sorted(self.items()))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+    @cached_property
+    def descriptions_by_code(self):
+        by_code = {}
+        for desc, code in self.items():
+            by_code.setdefault(normalize_code(code), desc)
+        return by_code
+
+    def lookup_code(self, code):
+        """(Code, Beschreibung) aus dem Katalog oder None, wenn es den Code nicht gibt."""
+        desc = self.descriptions_by_code.get(normalize_code(code))
+        return (self[desc], desc.title()) if desc else None
+
+    def clear_memo(self):
+        """Memo der Fuzzy-Suche leeren (Benchmarks: jeder Brief zahlt die volle Suche)."""
+        self._fuzzy_memo.clear()
+
+    def similar_token(self, token, threshold=0.85):
+        """Bestes Vokabular-Token nach Trigramm-Dice-Ähnlichkeit (oder None)."""
+        memo_key = (token, threshold)
+        if memo_key in self._fuzzy_memo:
+            return self._fuzzy_memo[memo_key]
+
+        grams = trigrams(token)
+        # Prefix-Filter: ein Treffer mit Dice >= threshold muss mindestens `required`
+        # Trigramme teilen, also eines der seltensten len - required + 1 Trigramme.
+        required = math.ceil(threshold * len(grams) / (2 - threshold))
+        rare_first = sorted(grams, key=lambda g: len(self.trigram_index.get(g, ())))
+        candidates = set()
+        for gram in rare_first[:len(grams) - required + 1]:
+            candidates.update(self.trigram_index.get(gram, ()))
+
+        best, best_score = None, threshold
+        for candidate in candidates:
+            other = self.token_trigrams[candidate]
+            score = 2 * len(grams & other) / (len(grams) + len(other))
+            if score >= best_score:
+                best, best_score = candidate, score
+        result = (best, best_score) if best else None
+
+        if len(self._fuzzy_memo) > 50000:
+            self._fuzzy_memo.clear()
+        self._fuzzy_memo[memo_key] = result
+        return result
+
+    def match_tokens(self, text, threshold=0.85):
+        matched = {}
+        for token in set(tokenize(text)):
+            if token in self.token_index:
+                matched[token] = 1.0
+                continue
+            close = self.similar_token(token, threshold)
+            if close:
+                vocab_token, score = close
+                matched[vocab_token] = max(matched.get(vocab_token, 0.0), score)
+        return matched
+
+    def candidates(self, text, threshold=0.85):
+        matched = self.match_tokens(text, threshold=threshold)
+        hits = defaultdict(float)
+        for token, weight in matched.items():
+            for desc in self.token_index[token]:
+                hits[desc] += self.idf[token] * weight
+        return hits
+
+    def score(self, text, threshold=0.85):
+        """Beschreibungen mit Ähnlichkeit (0..1) zum Text, absteigend sortiert."""
+        scored = []
+        for desc, hit_weight in self.candidates(text, threshold=threshold).items():
+            scored.append((hit_weight / self.desc_weight[desc], hit_weight, desc))
+        scored.sort(key=lambda x: (-x[0], -x[1], x[2]))
+        return [(desc, similarity) for similarity, _, desc in scored]
+
+    def search(self, text, top_n=None, threshold=0.85):
+        scored = self.score(text, threshold=threshold)
+        if top_n is not None:
+            scored = scored[:top_n]
+        return [(desc.title(), self[desc]) for desc, _ in scored]
@@ -0,0 +1,196 @@
+import contextvars
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from metrics import record_usage, span
+
+SYSTEM_PROMPT = """Du bist ein medizinischer Assistent, der aus Transkripten von Arzt-Patienten-Gesprächen strukturierte Arztbriefe erstellt.
+Gliedere den Brief in folgende Abschnitte:
+
+Anamnese, Diagnose, Therapie, Aufklärung, Organisatorisches, Operationsplanung, Patientenwunsch.
+
+Verwende eine sachliche, medizinisch korrekte Ausdrucksweise. Vermute keine Inhalte, die nicht im Text vorkommen."""
+
+STRUCTURED_PROMPT_SUFFIX = """
+
+Gib zusätzlich bis zu 5 ICD-10-GM-Codes an, die die genannten Diagnosen kodieren.
+Antworte ausschließlich im vorgegebenen JSON-Format; jeder Abschnitt hat einen Titel und seinen Inhalt."""
+
+# Ein Aufruf liefert Brief und ICD-Vorschläge; "strict" erzwingt genau dieses Schema
+STRUCTURED_LETTER_SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["abschnitte", "icd_codes"],
+    "properties": {
+        "abschnitte": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["titel", "inhalt"],
+                "properties": {"titel": {"type": "string"}, "inhalt": {"type": "string"}},
+            },
+        },
+        "icd_codes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["code", "bezeichnung"],
+                "properties": {
+                    "code": {"type": "string", "description": "ICD-10-GM-Code, z. B. J20.9"},
+                    "bezeichnung": {"type": "string"},
+                },
+            },
+        },
+    },
+}
+
+
+def messages_size(messages):
+    return sum(len(m.get("content") or "") for m in messages)
+
+
+def build_messages(system_prompt, transcript):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": transcript}
+    ]
+
+
+def stream_letter(client, messages, model="gpt-4o", temperature=0.3, timings=None):
+    """Liefert den Arztbrief tokenweise, während GPT ihn noch schreibt.
+
+    `timings` (optional, dict) erhält `time_to_first_token` und `total` in Sekunden.
+    """
+    timings = timings if timings is not None else {}
+    start = time.perf_counter()
+    with span("chat_completion", model=model, input_size=messages_size(messages)) as attrs:
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        output_size = 0
+        for chunk in stream:
+            # Mit include_usage kommt der Verbrauch in einem letzten Chunk ohne choices
+            record_usage(attrs, getattr(chunk, "usage", None))
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if "time_to_first_token" not in timings:
+                    timings["time_to_first_token"] = time.perf_counter() - start
+                output_size += len(delta)
+                yield delta
+        timings["total"] = time.perf_counter() - start
+        attrs.update(output_size=output_size, time_to_first_token=timings.get("time_to_first_token"))
+
+
+async def astream_letter(client, messages, model="gpt-4o", temperature=0.3, timings=None):
+    """Async-Variante von `stream_letter` für `AsyncOpenAI`."""
+    timings = timings if timings is not None else {}
+    start = time.perf_counter()
+    with span("chat_completion", model=model, input_size=messages_size(messages)) as attrs:
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        output_size = 0
+        async for chunk in stream:
+            record_usage(attrs, getattr(chunk, "usage", None))
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if "time_to_first_token" not in timings:
+                    timings["time_to_first_token"] = time.perf_counter() - start
+                output_size += len(delta)
+                yield delta
+        timings["total"] = time.perf_counter() - start
+        attrs.update(output_size=output_size, time_to_first_token=timings.get("time_to_first_token"))
+
+
+def generate_letter(client, messages, model="gpt-4o", temperature=0.3, timings=None):
+    return "".join(stream_letter(client, messages, model=model, temperature=temperature, timings=timings)).strip()
+
+
+def generate_letter_variants(client, system_prompts, transcript, model="gpt-4o", temperature=0.3,
+                             cache=None, max_workers=4, on_result=None):
+    """Mehrere Briefvarianten (Name → Systemprompt) gleichzeitig aus demselben Transkript.
+
+    Liefert Name → Brief; fehlgeschlagene Varianten stehen als Exception im Ergebnis.
+    Mit `cache` (GenerationCache) werden bereits erzeugte Varianten nicht erneut angefragt.
+    `on_result(name, result)` wird im aufrufenden Thread aufgerufen, sobald eine Variante fertig ist.
+    """
+    def generate(system_prompt):
+        messages = build_messages(system_prompt, transcript)
+
+        def produce():
+            return generate_letter(client, messages, model=model, temperature=temperature)
+
+        if cache is None:
+            return produce()
+        return cache.get_or_generate(cache.make_key(system_prompt, transcript, model, temperature), produce)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(system_prompts)))) as pool:
+        futures = {pool.submit(contextvars.copy_context().run, generate, prompt): name
+                   for name, prompt in system_prompts.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+            if on_result:
+                on_result(name, results[name])
+    return results
+
+
+def generate_structured_letter(client, messages, model="gpt-4o", temperature=0.3, timings=None):
+    """Brief-Abschnitte und ICD-Kandidaten als Dict in einem einzigen Aufruf.
+
+    Wirft ValueError, wenn das Modell ablehnt oder die Antwort abgeschnitten ist.
+    """
+    timings = timings if timings is not None else {}
+    start = time.perf_counter()
+    with span("chat_completion", model=model, input_size=messages_size(messages), structured=True) as attrs:
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "arztbrief", "strict": True, "schema": STRUCTURED_LETTER_SCHEMA},
+            }
+        )
+        record_usage(attrs, response.usage)
+        attrs["output_size"] = len(response.choices[0].message.content or "")
+    timings["total"] = time.perf_counter() - start
+    choice = response.choices[0]
+    if getattr(choice.message, "refusal", None):
+        raise ValueError(f"Modell hat abgelehnt: {choice.message.refusal}")
+    if choice.finish_reason == "length":
+        raise ValueError("Antwort wurde abgeschnitten (Token-Limit erreicht)")
+    return json.loads(choice.message.content)
+
+
+def structured_letter_text(letter):
+    return "\n\n".join(f"{s['titel'].strip()}\n{s['inhalt'].strip()}" for s in letter["abschnitte"])
+
+
+def format_timings(timings):
+    ttft = timings.get("time_to_first_token")
+    total = timings.get("total")
+    if total is None:
+        return ""
+    if ttft is None:
+        return f"⏱️ Brief vollständig nach {total:.2f} s"
+    return f"⏱️ Erstes Token nach {ttft:.2f} s · Brief vollständig nach {total:.2f} s"
@@ -0,0 +1,186 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from arztbrief_report import check_report_quality, create_pdf_report, insert_icds_into_diagnosis
+from audio_processing import prepare_upload_files, stitch_transcripts
+from letter_generation import SYSTEM_PROMPT, astream_letter, build_messages
+from metrics import METRICS, current_trace, span
+from openai_client import resolve_chat_model
+
+STAGES = ("ingest", "normalise", "transcribe", "generate", "code", "render")
+GENERATION_STAGES = ("generate", "code", "render")
+DEFAULT_CONCURRENCY = {"ingest": 4, "normalise": 2, "transcribe": 4, "generate": 4, "code": 2, "render": 2}
+
+_STOP = object()
+
+
+@dataclass
+class LetterJob:
+    job_id: str
+    source: str = None
+    audio_bytes: bytes = field(default=None, repr=False)
+    upload_files: list = field(default=None, repr=False)
+    transcript: str = None
+    letter: str = None
+    letter_with_icd: str = None
+    quality_checks: list = None
+    pdf_bytes: bytes = field(default=None, repr=False)
+    timings: dict = field(default_factory=dict)
+    generation_timings: dict = field(default_factory=dict)
+    error: str = None
+    on_token: object = field(default=None, repr=False)
+
+
+class LetterPipeline:
+    """Asynchrone Arztbrief-Pipeline: ingest → normalise → transcribe → generate → code → render.
+
+    Die Stufen sind über begrenzte Queues verbunden; jede Stufe hat eigene Worker
+    (`concurrency`), sodass viele Briefe gleichzeitig unterwegs sind und eine
+    langsame Stufe die vorderen über die Queue-Grösse ausbremst. Fehlgeschlagene
+    Jobs laufen mit gesetztem `error` ohne weitere Verarbeitung bis zum Ende durch.
+    Bringt ein Job ein Zwischenergebnis schon mit (`transcript`, `letter`,
+    `letter_with_icd`, z. B. beim Fortsetzen eines Batch-Laufs), entfallen die
+    Stufen, die es erzeugen würden; sie werden auch nicht gemessen.
+
+    Ohne `transcription_backend` transkribiert die Pipeline selbst über whisper-1
+    (asynchron, Abschnitte parallel); mit einem lokalen Backend läuft dieses im Thread-Pool.
+
+    `client_factory` liefert pro Lauf einen `AsyncOpenAI`-Client, der am Ende des
+    Laufs geschlossen wird; so funktioniert die Pipeline auch aus Streamlit, wo
+    jeder Lauf eine eigene Event-Loop bekommt.
+    """
+
+    def __init__(self, client_factory, icd_map=None, system_prompt=SYSTEM_PROMPT, model="gpt-4o",
+                 temperature=0.3, language="de", logo_path=None, concurrency=None, queue_size=8,
+                 transcription_cache=None, coder=None, renderer=None, transcription_backend=None):
+        self.client_factory = client_factory
+        self.icd_map = icd_map
+        self.system_prompt = system_prompt
+        self.model = model
+        self.temperature = temperature
+        self.language = language
+        self.logo_path = logo_path
+        self.concurrency = {**DEFAULT_CONCURRENCY, **(concurrency or {})}
+        self.queue_size = queue_size
+        self.transcription_cache = transcription_cache
+        self.transcription_backend = transcription_backend
+        self.transcription_model = transcription_backend.model_id if transcription_backend else "whisper-1"
+        self.coder = coder or (lambda text: insert_icds_into_diagnosis(text, self.icd_map))
+        self.renderer = renderer or (lambda text: create_pdf_report(text, logo_path=self.logo_path).getvalue())
+
+    async def run(self, jobs, stages=STAGES):
+        """Async-Generator, der fertige Jobs in Abschlussreihenfolge liefert."""
+        stages = [stage for stage in STAGES if stage in stages]
+        async with self.client_factory() as client:
+            queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(len(stages) + 1)]
+            tasks = [asyncio.create_task(self._feed(jobs, queues[0], self.concurrency[stages[0]]))]
+            for i, stage in enumerate(stages):
+                next_workers = self.concurrency[stages[i + 1]] if i + 1 < len(stages) else 1
+                tasks.append(asyncio.create_task(self._run_stage(stage, client, queues[i], queues[i + 1], next_workers)))
+            try:
+                while True:
+                    job = await queues[-1].get()
+                    if job is _STOP:
+                        break
+                    yield job
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    def run_sync(self, jobs, stages=STAGES):
+        async def collect():
+            return [job async for job in self.run(jobs, stages=stages)]
+        return asyncio.run(collect())
+
+    async def _feed(self, jobs, queue, workers):
+        for job in jobs:
+            await queue.put(job)
+        for _ in range(workers):
+            await queue.put(_STOP)
+
+    async def _run_stage(self, stage, client, inbox, outbox, next_workers):
+        await asyncio.gather(*(self._worker(stage, client, inbox, outbox) for _ in range(self.concurrency[stage])))
+        for _ in range(next_workers):
+            await outbox.put(_STOP)
+
+    async def _worker(self, stage, client, inbox, outbox):
+        handler = getattr(self, f"_{stage}")
+        while True:
+            job = await inbox.get()
+            if job is _STOP:
+                return
+            if job.error is None and not self._has_result(stage, job):
+                # Jede Worker-Coroutine läuft als eigener Task; die Trace-ID gilt daher nur für diesen Job
+                trace = current_trace.set(job.job_id)
+                start = time.perf_counter()
+                try:
+                    await handler(client, job)
+                except Exception as e:
+                    job.error = f"{stage}: {type(e).__name__}: {e}"
+                job.timings[stage] = time.perf_counter() - start
+                METRICS.record(f"pipeline_{stage}", job.timings[stage], error=job.error is not None)
+                current_trace.reset(trace)
+            await outbox.put(job)
+
+    @staticmethod
+    def _has_result(stage, job):
+        if stage in ("ingest", "normalise", "transcribe"):
+            return job.transcript is not None
+        if stage == "generate":
+            return job.letter is not None
+        if stage == "code":
+            return job.letter_with_icd is not None and job.quality_checks is not None
+        return False
+
+    async def _ingest(self, client, job):
+        if job.audio_bytes is None and job.transcript is None and job.source:
+            job.audio_bytes = await asyncio.to_thread(Path(job.source).read_bytes)
+        if self.transcription_cache and job.transcript is None:
+            key = self.transcription_cache.make_key(job.audio_bytes, model=self.transcription_model,
+                                                    language=self.language)
+            job.transcript = self.transcription_cache.get(key)
+
+    async def _normalise(self, client, job):
+        if job.transcript is None and self.transcription_backend is None:
+            job.upload_files = await asyncio.to_thread(prepare_upload_files, job.audio_bytes)
+
+    async def _transcribe(self, client, job):
+        if job.transcript is not None:
+            return
+        if self.transcription_backend is not None:
+            job.transcript = await asyncio.to_thread(self.transcription_backend.transcribe_bytes, job.audio_bytes)
+        else:
+            with span("transcription", input_size=len(job.audio_bytes), model="whisper-1") as attrs:
+                results = await asyncio.gather(*(
+                    client.audio.transcriptions.create(model="whisper-1", file=upload, language=self.language)
+                    for upload in job.upload_files
+                ))
+                job.transcript = stitch_transcripts([r.text for r in results])
+                attrs["output_size"] = len(job.transcript)
+        if self.transcription_cache:
+            key = self.transcription_cache.make_key(job.audio_bytes, model=self.transcription_model,
+                                                    language=self.language)
+            self.transcription_cache.put(key, job.transcript)
+        job.audio_bytes = None
+        job.upload_files = None
+
+    async def _generate(self, client, job):
+        messages = build_messages(self.system_prompt, f"Hier ist das Gespräch:\n{job.transcript}")
+        parts = []
+        async for delta in astream_letter(client, messages, model=resolve_chat_model(self.model),
+                                          temperature=self.temperature, timings=job.generation_timings):
+            parts.append(delta)
+            if job.on_token:
+                job.on_token(delta)
+        job.letter = "".join(parts).strip()
+
+    async def _code(self, client, job):
+        if job.letter_with_icd is None:
+            job.letter_with_icd = await asyncio.to_thread(self.coder, job.letter)
+        job.quality_checks = check_report_quality(job.letter_with_icd)
+
+    async def _render(self, client, job):
+        job.pdf_bytes = await asyncio.to_thread(self.renderer, job.letter_with_icd)
@@ -0,0 +1,159 @@
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+# Zerlegt den GPT-Brieftext einmal in Abschnitte. PDF-Export, ICD-Ergänzung und
+# Regelprüfung arbeiten auf diesem Objekt statt den Text jeweils neu zu zerschneiden.
+#
+# Eine Zeile gilt als Überschrift, wenn sie
+#   - ein bekannter Abschnittstitel ist, auch mitten im Block und mit Inhalt nach dem
+#     Doppelpunkt ("Diagnose: Gonarthrose"), mit Markdown (**, ##) oder Nummerierung,
+#   - als Markdown-Überschrift markiert ist ("## Verlauf", "**Procedere**"), oder
+#   - einen Block beginnt, kurz ist und mit Doppelpunkt endet ("Untersuchungsbefunde:").
+# Alle übrigen Zeilen gehören zum laufenden Abschnitt, vor der ersten Überschrift zur Einleitung;
+# ein zweiter Absatz ohne solche Markierung setzt also den Abschnitt fort. Eine Grussformel
+# beginnt den Briefschluss.
+
+KNOWN_TITLE_PATTERN = re.compile(
+    r"(anamnese|diagnosen?|diagnose\(n\)|therapie(empfehlung)?|aufklärung|organisatorisches"
+    r"|operationsplanung|patientenwunsch|aufnahmegrund|anlass|befunde?|untersuchungsbefunde?|verlauf"
+    r"|entlassungsdiagnosen?|entlassungsdiagnose\(n\)|empfehlung(en)?|medikation|procedere)",
+    re.IGNORECASE,
+)
+NUMBERING_PATTERN = re.compile(r"^\d+[.)]\s+")
+BULLETS = ("- ", "• ", "* ", "– ")
+MAX_HEADING_LENGTH = 80
+# Grussformel am Blockanfang: ab hier Schluss des Briefs, nicht mehr Inhalt des letzten Abschnitts
+CLOSING_PATTERN = re.compile(r"(mit )?(freundlichen|besten|kollegialen) gr(ü|u)(ss|ß)en|hochachtungsvoll", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class Section:
+    title: str
+    heading: str
+    inline: str = ""
+    lines: tuple = ()
+    # Zeilenindex im Originaltext direkt nach dem letzten nicht-leeren Inhalt des Abschnitts
+    end: int = 0
+
+    @property
+    def content(self):
+        return "\n".join((self.inline, *self.lines) if self.inline else self.lines).strip()
+
+
+@dataclass(frozen=True)
+class Letter:
+    preamble: str
+    sections: tuple
+    closing: str = ""
+    source: str = field(default="", repr=False)
+
+    def find(self, name):
+        """Erster Abschnitt, dessen Titel mit `name` beginnt, sonst der erste, der ihn enthält."""
+        name = name.lower()
+        for section in self.sections:
+            if section.title.lower().startswith(name):
+                return section
+        for section in self.sections:
+            if name in section.title.lower():
+                return section
+        return None
+
+    def insert_after(self, section, extra_lines):
+        """Originaltext mit `extra_lines` direkt nach dem Inhalt von `section`; alles andere bleibt unverändert."""
+        lines = self.source.splitlines(keepends=True)
+        head = "".join(lines[:section.end])
+        tail = "".join(lines[section.end:])
+        if head and not head.endswith(("\n", "\r")):
+            head += "\n"
+        block = "\n".join(extra_lines)
+        if tail:
+            return head + block + "\n" + tail
+        return head + block + ("\n" if self.source.endswith(("\n", "\r")) else "")
+
+
+def _strip_markup(line):
+    text = line.strip().lstrip("#").strip().replace("**", "").replace("__", "").strip()
+    return NUMBERING_PATTERN.sub("", text)
+
+
+def _known_heading(line):
+    title, _, inline = _strip_markup(line).partition(":")
+    title = title.strip()
+    if KNOWN_TITLE_PATTERN.fullmatch(title):
+        return title, inline.strip()
+    return None
+
+
+def _free_heading(line, block_start):
+    if len(line) > MAX_HEADING_LENGTH or line.startswith(BULLETS):
+        return None
+    marked = line.startswith("#") or (line.startswith(("**", "__")) and line.endswith(("**", "__", "**:", "__:")))
+    title = _strip_markup(line)
+    if not marked and not (block_start and title.endswith(":")):
+        return None
+    return title.rstrip(":").strip() or None
+
+
+def _trim(lines, keep_leading=False):
+    start, end = 0, len(lines)
+    while not keep_leading and start < end and not lines[start].strip():
+        start += 1
+    while end > start and not lines[end - 1].strip():
+        end -= 1
+    return tuple(line.rstrip() for line in lines[start:end])
+
+
+@lru_cache(maxsize=256)
+def parse_letter(text):
+    """Brieftext → `Letter`; ein Durchlauf über die Zeilen. Ergebnis ist unveränderlich und gecacht."""
+    lines = text.splitlines()
+    preamble = []
+    sections = []
+    closing = []
+    current = preamble
+    block_start = True
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if current is closing:
+            closing.append(line)
+            continue
+        if not stripped:
+            current.append("")
+            block_start = True
+            continue
+        if block_start and CLOSING_PATTERN.match(_strip_markup(stripped)):
+            closing.append(line)
+            current = closing
+            continue
+
+        heading = _known_heading(stripped)
+        if heading is None:
+            title = _free_heading(stripped, block_start)
+            heading = (title, "") if title else None
+        block_start = False
+
+        if heading is None:
+            current.append(line)
+            if sections:
+                sections[-1][4] = i + 1
+            continue
+        title, inline = heading
+        current = []
+        sections.append([title, stripped, inline, current, i + 1])
+
+    return Letter(
+        preamble="\n".join(_trim(preamble)),
+        sections=tuple(
+            # Mit Inhalt in der Überschriftzeile bleibt eine folgende Leerzeile Teil des Abschnitts
+            Section(title=title, heading=heading, inline=inline, lines=_trim(body, keep_leading=bool(inline)),
+                    end=end)
+            for title, heading, inline, body, end in sections
+        ),
+        closing="\n".join(_trim(closing)),
+        source=text,
+    )
+
+
+def as_letter(report):
+    return report if isinstance(report, Letter) else parse_letter(report)
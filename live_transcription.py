@@ -0,0 +1,203 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from audio_processing import (
+    OVERLAP_MS, SPEECH_SAMPLE_RATE, StreamingDecoder, export_chunk, nearest_pause, pcm_to_segment, stitch_transcripts
+)
+
+LIVE_SEGMENT_MS = 30 * 1000
+LIVE_SEARCH_MS = 5 * 1000
+PCM_BYTES_PER_MS = SPEECH_SAMPLE_RATE * 2 // 1000
+
+
+class _LiveSession:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.updated = time.monotonic()
+        self.last_processed = 0.0
+        self.decoder = None
+        self.next_seq = 0
+        # Dekodiertes PCM ab `pcm_start_ms`; älteres Audio ist transkribiert und wird verworfen
+        self.pcm = bytearray()
+        self.pcm_start_ms = 0
+        self.committed_ms = 0
+        self.futures = []
+        self.failed = False
+
+    @property
+    def decoded_ms(self):
+        return self.pcm_start_ms + len(self.pcm) // PCM_BYTES_PER_MS
+
+    def audio(self, start_ms, end_ms):
+        start = (start_ms - self.pcm_start_ms) * PCM_BYTES_PER_MS
+        end = (end_ms - self.pcm_start_ms) * PCM_BYTES_PER_MS
+        return pcm_to_segment(bytes(self.pcm[start:end]))
+
+    def discard_before(self, ms):
+        drop = max(0, ms - self.pcm_start_ms)
+        del self.pcm[:drop * PCM_BYTES_PER_MS]
+        self.pcm_start_ms += drop
+
+    def close(self):
+        if self.decoder is not None:
+            self.decoder.close()
+            self.decoder = None
+
+
+class LiveTranscriber:
+    """Transkribiert Browser-Aufnahmen abschnittsweise, während noch aufgenommen wird.
+
+    Hängt sich als Listener an einen `RecordingStore`. Jede Aufnahme hat einen
+    eigenen ffmpeg-Decoder, dem nur die neu eingetroffenen Chunks übergeben werden;
+    das dekodierte PCM wird etwa alle `segment_ms` an einer Sprechpause geschnitten
+    und der neue Abschnitt an whisper geschickt. Beim Stoppen fehlt nur noch der
+    letzte Abschnitt. Sind bereits `max_workers + max_queued` Abschnitte unterwegs,
+    wird erst beim nächsten Chunk weiter geschnitten, statt den Decode-Thread zu blockieren.
+
+    Sitzungen ohne neuen Chunk seit `idle_seconds` (Tab geschlossen) werden von einem
+    Hintergrund-Thread beendet, samt ffmpeg-Prozess; abgeschlossene, nie abgeholte
+    Ergebnisse verfallen nach `ttl_seconds`.
+    """
+
+    def __init__(self, store, transcribe, segment_ms=LIVE_SEGMENT_MS, overlap_ms=OVERLAP_MS,
+                 max_workers=2, max_queued=4, ttl_seconds=3600, idle_seconds=300):
+        self.store = store
+        self.transcribe = transcribe
+        self.segment_ms = segment_ms
+        self.overlap_ms = overlap_ms
+        self.ttl_seconds = ttl_seconds
+        self.idle_seconds = idle_seconds
+        self.max_pending = max_workers + max_queued
+        self._transcribe_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="live-whisper")
+        self._decode_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="live-decode")
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        store.add_listener(self.on_recording_update)
+        self._reaper = threading.Thread(target=self._reap, name="live-session-reaper", daemon=True)
+        self._reaper.start()
+
+    def _session(self, recording_id):
+        with self._sessions_lock:
+            session = self._sessions.get(recording_id)
+            if session is None:
+                session = self._sessions[recording_id] = _LiveSession()
+            session.updated = time.monotonic()
+            return session
+
+    def _reap(self):
+        while True:
+            time.sleep(min(self.idle_seconds, 60))
+            self.expire()
+
+    def expire(self):
+        """Verlassene und nie abgeholte Sitzungen beenden; läuft periodisch im Hintergrund."""
+        now = time.monotonic()
+        with self._sessions_lock:
+            stale = [
+                (recording_id, session) for recording_id, session in self._sessions.items()
+                if now - session.updated > (self.ttl_seconds if session.done.is_set() else self.idle_seconds)
+            ]
+        for recording_id, session in stale:
+            # Eine gerade laufende Verarbeitung nicht unterbrechen; der nächste Durchlauf holt sie nach
+            if not session.lock.acquire(blocking=False):
+                continue
+            try:
+                session.close()
+                if not session.done.is_set():
+                    session.failed = True
+                    session.done.set()
+            finally:
+                session.lock.release()
+            with self._sessions_lock:
+                if self._sessions.get(recording_id) is session:
+                    del self._sessions[recording_id]
+
+    def on_recording_update(self, recording_id, finished):
+        session = self._session(recording_id)
+        if finished:
+            self._decode_pool.submit(self._process, recording_id, session, True)
+        elif time.monotonic() - session.last_processed >= self.segment_ms / 1000 and not session.lock.locked():
+            self._decode_pool.submit(self._process, recording_id, session, False)
+
+    def _process(self, recording_id, session, final):
+        with session.lock:
+            if session.done.is_set():
+                return
+            session.last_processed = time.monotonic()
+            try:
+                self._decode_new(recording_id, session, final)
+                self._cut_segments(session, final)
+            except Exception:
+                # Live-Transkription aufgeben: result() liefert None, der Aufrufer transkribiert die ganze Aufnahme
+                session.failed = True
+            finally:
+                if final or session.failed:
+                    session.close()
+                    session.done.set()
+
+    def _decode_new(self, recording_id, session, final):
+        snapshot = self.store.snapshot(recording_id, session.next_seq)
+        if snapshot is None:
+            raise KeyError(recording_id)
+        data, session.next_seq = snapshot
+        if session.decoder is None:
+            session.decoder = StreamingDecoder()
+        if data:
+            session.decoder.feed(data)
+        if final:
+            session.decoder.finish()
+        session.pcm += session.decoder.take()
+
+    def _cut_segments(self, session, final):
+        while session.decoded_ms > session.committed_ms:
+            remaining = session.decoded_ms - session.committed_ms
+            if final:
+                cut = session.decoded_ms
+            elif remaining < self.segment_ms + LIVE_SEARCH_MS or self._queue_full():
+                break
+            else:
+                # Nur das Fenster um die Zielposition betrachten, nicht die ganze bisherige Aufnahme
+                window = session.audio(session.committed_ms, session.committed_ms + self.segment_ms + LIVE_SEARCH_MS)
+                cut = session.committed_ms + nearest_pause(window, self.segment_ms, search_ms=LIVE_SEARCH_MS)
+
+            segment = session.audio(max(session.pcm_start_ms, session.committed_ms - self.overlap_ms), cut)
+            with self._pending_lock:
+                self._pending += 1
+            session.futures.append(self._transcribe_pool.submit(self._transcribe_segment, segment, len(session.futures)))
+            session.committed_ms = cut
+            session.discard_before(cut - self.overlap_ms)
+
+    def _queue_full(self):
+        with self._pending_lock:
+            return self._pending >= self.max_pending
+
+    def _transcribe_segment(self, segment, index):
+        try:
+            return self.transcribe(export_chunk(segment, index))
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+
+    def result(self, recording_id, timeout=None):
+        """Zusammengefügtes Transkript einer abgeschlossenen Aufnahme.
+
+        None, wenn es keine Live-Sitzung gibt oder ein Abschnitt fehlgeschlagen ist;
+        der Aufrufer transkribiert dann die vollständige Aufnahme.
+        """
+        with self._sessions_lock:
+            session = self._sessions.get(recording_id)
+        if session is None or not session.done.wait(timeout):
+            return None
+        with self._sessions_lock:
+            self._sessions.pop(recording_id, None)
+        if session.failed:
+            return None
+        try:
+            texts = [future.result() for future in session.futures]
+        except Exception:
+            return None
+        return stitch_transcripts(texts)
@@ -0,0 +1,204 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+# Messwerte je Verarbeitungsstufe (Temp-Datei, ffmpeg, Transkription, Chat, ICD, Prüfung, PDF).
+# ARZTBRIEF_METRICS_PORT  → Prometheus-Endpunkt unter /metrics
+# ARZTBRIEF_METRICS_HOST  → Bind-Adresse dafür (Standard 127.0.0.1, nur lokal erreichbar)
+# ARZTBRIEF_METRICS_JSONL → jedes Ereignis als JSON-Zeile in diese Datei
+# ARZTBRIEF_DEBUG_PANEL   → Messwerte der eigenen Sitzung in der Seitenleiste (V9)
+
+# Obergrenzen der Prometheus-Histogramm-Buckets in Sekunden
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+current_trace = contextvars.ContextVar("arztbrief_trace", default=None)
+
+
+class _StageStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.duration_sum = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.input_size = 0
+        self.output_size = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+
+class MetricsRegistry:
+    """Sammelt Dauer, Nutzdatengrösse und Token-Verbrauch je Verarbeitungsstufe.
+
+    Aggregiert für den Prometheus-Endpunkt, die letzten Ereignisse zusätzlich als
+    Ringpuffer für das Debug-Panel und optional zeilenweise als JSONL-Datei.
+    """
+
+    def __init__(self, jsonl_path=None, recent_events=1000):
+        self.jsonl_path = jsonl_path
+        self._stats = defaultdict(_StageStats)
+        self._recent = deque(maxlen=recent_events)
+        self._lock = threading.Lock()
+        # Eigene Sperre und eine offene Datei: Schreiben blockiert nicht die Aggregation der anderen Threads
+        self._jsonl_file = None
+        self._jsonl_lock = threading.Lock()
+
+    def record(self, stage, duration, error=False, **attrs):
+        event = {"ts": time.time(), "stage": stage, "duration_s": duration, "trace": current_trace.get()}
+        if error:
+            event["error"] = True
+        event.update((k, v) for k, v in attrs.items() if v is not None)
+        with self._lock:
+            stats = self._stats[stage]
+            stats.count += 1
+            stats.errors += bool(error)
+            stats.duration_sum += duration
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    stats.buckets[i] += 1
+            stats.input_size += event.get("input_size", 0)
+            stats.output_size += event.get("output_size", 0)
+            stats.prompt_tokens += event.get("prompt_tokens", 0)
+            stats.completion_tokens += event.get("completion_tokens", 0)
+            self._recent.append(event)
+        if self.jsonl_path:
+            self._write_jsonl(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def _write_jsonl(self, line):
+        with self._jsonl_lock:
+            if self._jsonl_file is None:
+                self._jsonl_file = open(self.jsonl_path, "a", encoding="utf-8")
+            self._jsonl_file.write(line)
+            self._jsonl_file.flush()
+
+    def recent(self, trace=None, limit=200):
+        with self._lock:
+            events = [e for e in self._recent if trace is None or e["trace"] == trace]
+        return events[-limit:]
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP arztbrief_stage_duration_seconds Dauer je Verarbeitungsstufe",
+            "# TYPE arztbrief_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            stats = sorted(self._stats.items())
+            for stage, s in stats:
+                for bound, count in zip(DURATION_BUCKETS, s.buckets):
+                    lines.append(f'arztbrief_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'arztbrief_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {s.count}')
+                lines.append(f'arztbrief_stage_duration_seconds_sum{{stage="{stage}"}} {s.duration_sum}')
+                lines.append(f'arztbrief_stage_duration_seconds_count{{stage="{stage}"}} {s.count}')
+            counters = [
+                ("arztbrief_stage_errors_total", "Fehlgeschlagene Aufrufe je Stufe", "errors"),
+                ("arztbrief_stage_input_size_total", "Eingabegrösse je Stufe (Bytes bzw. Zeichen)", "input_size"),
+                ("arztbrief_stage_output_size_total", "Ausgabegrösse je Stufe (Bytes bzw. Zeichen)", "output_size"),
+                ("arztbrief_openai_prompt_tokens_total", "Prompt-Tokens laut API-Antwort", "prompt_tokens"),
+                ("arztbrief_openai_completion_tokens_total", "Completion-Tokens laut API-Antwort",
+                 "completion_tokens"),
+            ]
+            for name, help_text, field in counters:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                lines += [f'{name}{{stage="{stage}"}} {getattr(s, field)}' for stage, s in stats]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry(jsonl_path=os.environ.get("ARZTBRIEF_METRICS_JSONL"))
+
+
+def payload_size(value):
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, BytesIO):
+        return value.getbuffer().nbytes
+    if isinstance(value, tuple) and len(value) == 2 and isinstance(value[1], bytes):
+        return len(value[1])
+    return None
+
+
+@contextmanager
+def span(stage, **attrs):
+    """Misst einen Block; zusätzliche Attribute (Grössen, Tokens) können ins gelieferte Dict."""
+    start = time.perf_counter()
+    error = False
+    try:
+        yield attrs
+    except Exception:
+        error = True
+        raise
+    finally:
+        METRICS.record(stage, time.perf_counter() - start, error=error, **attrs)
+
+
+def traced(stage):
+    """Decorator: Dauer, Grösse des ersten Text-/Byte-Arguments und des Ergebnisses erfassen."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            first = next((a for a in args if payload_size(a) is not None), None)
+            with span(stage, input_size=payload_size(first) if first is not None else None) as attrs:
+                result = fn(*args, **kwargs)
+                attrs["output_size"] = payload_size(result)
+                return result
+        return wrapper
+    return decorate
+
+
+def record_usage(attrs, usage):
+    if usage is not None:
+        attrs["prompt_tokens"] = getattr(usage, "prompt_tokens", None)
+        attrs["completion_tokens"] = getattr(usage, "completion_tokens", None)
+
+
+def _make_metrics_handler(registry):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+_server = None
+_server_failed = False
+_server_lock = threading.Lock()
+
+
+def ensure_metrics_server(port=None, host=None):
+    """Startet einmal pro Prozess /metrics, wenn ARZTBRIEF_METRICS_PORT (oder `port`) gesetzt ist.
+
+    Ist der Port belegt, bleibt der Exporter für diesen Prozess abgeschaltet (Rückgabe None).
+    """
+    global _server, _server_failed
+    if port is None:
+        port = os.environ.get("ARZTBRIEF_METRICS_PORT")
+    if port is None or port == "":
+        return None
+    if host is None:
+        host = os.environ.get("ARZTBRIEF_METRICS_HOST", "127.0.0.1")
+    with _server_lock:
+        if _server is None and not _server_failed:
+            try:
+                _server = ThreadingHTTPServer((host, int(port)), _make_metrics_handler(METRICS))
+            except OSError as e:
+                _server_failed = True
+                print(f"⚠️ Metrics-Endpunkt {host}:{port} nicht verfügbar, Export abgeschaltet: {e}")
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+        return _server
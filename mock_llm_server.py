@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# OpenAI-kompatibler Stand-in für Lasttests und Offline-Betrieb: liefert vorbereitete
+# Arztbriefe mit einstellbarer Latenz. Dieselbe Anfrage ergibt immer dieselbe Antwort,
+# sodass Messungen den Durchsatz der App und nicht die Modelllatenz zeigen.
+
+CANNED_LETTERS = [
+    {
+        "abschnitte": [
+            ("Anamnese", "Seit drei Tagen trockener Husten, subfebrile Temperaturen bis 38,1 °C, kein Auswurf."),
+            ("Diagnose", "Akute Bronchitis"),
+            ("Therapie", "Inhalation mit Kochsalzlösung zweimal täglich, ausreichende Flüssigkeitszufuhr."),
+            ("Aufklärung", "Patient über den selbstlimitierenden Verlauf und Warnzeichen aufgeklärt."),
+            ("Organisatorisches", "Blutbild bei Persistenz über zwei Wochen."),
+            ("Operationsplanung", "Keine."),
+            ("Patientenwunsch", "Arbeitsunfähigkeitsbescheinigung für drei Tage."),
+        ],
+        "icd_codes": [("J20.9", "Akute Bronchitis, nicht näher bezeichnet")],
+    },
+    {
+        "abschnitte": [
+            ("Anamnese", "Zunehmende belastungsabhängige Schmerzen im rechten Knie seit einem Jahr."),
+            ("Diagnose", "Primäre Gonarthrose rechts"),
+            ("Therapie", "Physiotherapie, bedarfsweise Ibuprofen 400 mg."),
+            ("Aufklärung", "Risiken einer Knie-Totalendoprothese besprochen, Einwilligung erteilt."),
+            ("Organisatorisches", "Zuweisung zur präoperativen Abklärung, Blutbild und Gerinnung."),
+            ("Operationsplanung", "Knie-TEP rechts in sechs Wochen geplant."),
+            ("Patientenwunsch", "Operation vor den Sommerferien."),
+        ],
+        "icd_codes": [("M17.1", "Sonstige primäre Gonarthrose")],
+    },
+    {
+        "abschnitte": [
+            ("Anamnese", "Wiederholt erhöhte Blutdruckwerte bei Selbstmessung, gelegentlich Kopfschmerzen."),
+            ("Diagnose", "Essentielle Hypertonie"),
+            ("Therapie", "Beginn mit Ramipril 2,5 mg täglich, Kochsalzreduktion."),
+            ("Aufklärung", "Über Nebenwirkungen wie Reizhusten aufgeklärt."),
+            ("Organisatorisches", "Kontrolle von Kreatinin und Kalium in zwei Wochen."),
+            ("Operationsplanung", "Keine."),
+            ("Patientenwunsch", "Möglichst wenige Tabletten."),
+        ],
+        "icd_codes": [("I10.90", "Essentielle Hypertonie, nicht näher bezeichnet")],
+    },
+]
+
+CANNED_TRANSCRIPT = (
+    "Guten Tag, was führt Sie zu mir? Ich huste seit drei Tagen und habe leichtes Fieber. "
+    "Auswurf haben Sie keinen? Nein. Dann inhalieren Sie bitte zweimal täglich."
+)
+
+TOKEN_PATTERN = re.compile(r"\S+\s*")
+
+
+def letter_text(letter):
+    return "\n\n".join(f"{title}\n{content}" for title, content in letter["abschnitte"])
+
+
+def canned_reply(request):
+    """Antwort passend zum Aufruf: ICD-Liste, strukturiertes JSON oder Brieftext."""
+    messages = request.get("messages", [])
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).digest()
+    letter = CANNED_LETTERS[digest[0] % len(CANNED_LETTERS)]
+
+    system_prompt = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+    if "Kodierer" in system_prompt:
+        return "\n".join(f"{code}: {desc}" for code, desc in letter["icd_codes"])
+    if (request.get("response_format") or {}).get("type") == "json_schema":
+        return json.dumps({
+            "abschnitte": [{"titel": t, "inhalt": c} for t, c in letter["abschnitte"]],
+            "icd_codes": [{"code": code, "bezeichnung": desc} for code, desc in letter["icd_codes"]],
+        }, ensure_ascii=False)
+    return letter_text(letter)
+
+
+def make_handler(time_to_first_token=0.5, tokens_per_second=50.0, transcription_seconds=1.0):
+    class MockLLMHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _read_body(self):
+            if "chunked" in self.headers.get("Transfer-Encoding", ""):
+                parts = []
+                while True:
+                    size = int(self.rfile.readline().strip() or b"0", 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return b"".join(parts)
+                    parts.append(self.rfile.read(size))
+                    self.rfile.readline()
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_event(self, payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+            else:
+                self._send_json(404, {"error": {"message": "unbekannter Pfad"}})
+
+        def do_POST(self):
+            body = self._read_body()
+            if self.path.endswith("/chat/completions"):
+                self._chat(json.loads(body or b"{}"))
+            elif self.path.endswith("/audio/transcriptions"):
+                time.sleep(transcription_seconds)
+                self._send_json(200, {"text": CANNED_TRANSCRIPT})
+            else:
+                self._send_json(404, {"error": {"message": "unbekannter Pfad"}})
+
+        def _chat(self, request):
+            content = canned_reply(request)
+            tokens = TOKEN_PATTERN.findall(content)
+            model = request.get("model", "mock")
+            created = int(time.time())
+            time.sleep(time_to_first_token)
+
+            prompt_tokens = sum(len(m.get("content") or "") for m in request.get("messages", [])) // 4
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                     "total_tokens": prompt_tokens + len(tokens)}
+            if not request.get("stream"):
+                time.sleep(len(tokens) / tokens_per_second)
+                self._send_json(200, {
+                    "id": "chatcmpl-mock", "object": "chat.completion", "created": created, "model": model,
+                    "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                                 "message": {"role": "assistant", "content": content, "refusal": None}}],
+                    "usage": usage,
+                })
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(1 / tokens_per_second)
+                self._send_event(json.dumps({
+                    "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }, ensure_ascii=False))
+            self._send_event(json.dumps({
+                "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                self._send_event(json.dumps({
+                    "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [], "usage": usage,
+                }))
+            self._send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockLLMHandler
+
+
+def start_mock_server(host="127.0.0.1", port=8600, **latency):
+    server = ThreadingHTTPServer((host, port), make_handler(**latency))
+    thread = threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-kompatibler Mock-Server mit vorbereiteten Arztbriefen.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--ttft", type=float, default=0.5, help="Sekunden bis zum ersten Token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--transcription-seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(
+        time_to_first_token=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        transcription_seconds=args.transcription_seconds,
+    ))
+    print(f"Mock-LLM auf http://{args.host}:{args.port}/v1 – ARZTBRIEF_LLM_BASE_URL entsprechend setzen.")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
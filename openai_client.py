@@ -0,0 +1,182 @@
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+import openai
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+# Ein Timeout hat bereits die volle Timeout-Dauer gekostet; er bekommt ein eigenes, kleineres Wiederholungsbudget
+TIMEOUT_ERRORS = (openai.APITimeoutError,)
+
+DEFAULT_RPM = int(os.environ.get("ARZTBRIEF_OPENAI_RPM", "500"))
+DEFAULT_TPM = int(os.environ.get("ARZTBRIEF_OPENAI_TPM", "30000"))
+DEFAULT_HEDGE_SECONDS = float(os.environ.get("ARZTBRIEF_WHISPER_HEDGE_SECONDS", "30")) or None
+MAX_CACHED_CLIENTS = 32
+
+# Ein Pool für alle Clients: Threads entstehen erst bei Bedarf, und ein aus dem Cache
+# verdrängter Client hinterlässt keinen eigenen Executor
+_hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="whisper-hedge")
+
+# Briefgenerierung und ICD-Extraktion können an einen OpenAI-kompatiblen Endpunkt gehen
+# (llama.cpp-Server, vLLM, mock_llm_server); Transkription bleibt davon unberührt.
+LLM_BASE_URL = os.environ.get("ARZTBRIEF_LLM_BASE_URL")
+LLM_MODEL = os.environ.get("ARZTBRIEF_LLM_MODEL")
+LLM_API_KEY = os.environ.get("ARZTBRIEF_LLM_API_KEY", "local")
+
+
+class TokenBucket:
+    """Thread-sicherer Token-Bucket; `acquire` blockiert, bis genug Kontingent nachgeflossen ist."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                delay = (amount - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+def resolve_chat_model(model):
+    # In den Skripten ist "gpt-4o" fest verdrahtet; ein lokaler Endpunkt bedient meist ein anderes Modell
+    return LLM_MODEL or model
+
+
+def estimate_chat_tokens(kwargs):
+    # Grobe Schätzung (≈ 4 Zeichen pro Token) reicht, um das TPM-Kontingent nicht zu überziehen
+    prompt_chars = sum(len(m.get("content") or "") for m in kwargs.get("messages", []))
+    return prompt_chars // 4 + (kwargs.get("max_tokens") or 1024)
+
+
+class ResilientOpenAI:
+    """OpenAI-Client mit wiederverwendetem Verbindungspool, RPM/TPM-Drosselung und Wiederholungen.
+
+    Bietet dieselbe Oberfläche wie `OpenAI` für die hier genutzten Aufrufe
+    (`audio.transcriptions.create`, `chat.completions.create`), sodass bestehende
+    Helfer unverändert bleiben. 429/5xx/Verbindungsfehler werden mit exponentiellem
+    Backoff und Jitter wiederholt (Retry-After hat Vorrang), Timeouts nur
+    `max_timeout_retries`-mal. Transkriptionen, die nach `hedge_after` Sekunden noch
+    laufen, werden ein zweites Mal gestartet; die schnellere Antwort gewinnt.
+
+    Mit `llm_base_url` gehen Chat-Aufrufe an diesen Endpunkt, ungedrosselt, weil
+    dort keine OpenAI-Kontingente gelten.
+    """
+
+    def __init__(self, api_key=None, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, max_retries=5, max_timeout_retries=1,
+                 backoff_base=0.5, backoff_cap=30.0, chat_timeout=120.0, transcription_timeout=180.0,
+                 hedge_after=DEFAULT_HEDGE_SECONDS, llm_base_url=LLM_BASE_URL):
+        # Wiederholungen übernimmt _call; der Client selbst hält den Verbindungspool (Keep-Alive)
+        self.raw = openai.OpenAI(api_key=api_key, max_retries=0, timeout=openai.Timeout(chat_timeout, connect=10.0))
+        if llm_base_url:
+            self.chat_raw = openai.OpenAI(api_key=LLM_API_KEY, base_url=llm_base_url, max_retries=0,
+                                          timeout=openai.Timeout(chat_timeout, connect=10.0))
+        else:
+            self.chat_raw = self.raw
+        self.chat_rate_limited = not llm_base_url
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.max_timeout_retries = max_timeout_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.chat_timeout = chat_timeout
+        self.transcription_timeout = transcription_timeout
+        self.hedge_after = hedge_after
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat))
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self._create_transcription))
+
+    def _backoff(self, attempt, error):
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_cap)
+            except ValueError:
+                pass
+        # "Full Jitter": gleichverteilt bis zur exponentiell wachsenden Obergrenze
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def _call(self, create, estimated_tokens=0, rate_limited=True, **kwargs):
+        timeouts = 0
+        for attempt in range(self.max_retries + 1):
+            if rate_limited:
+                self.requests.acquire()
+            if rate_limited and estimated_tokens:
+                self.tokens.acquire(estimated_tokens)
+            try:
+                return create(**kwargs)
+            except TIMEOUT_ERRORS:
+                timeouts += 1
+                if attempt == self.max_retries or timeouts > self.max_timeout_retries:
+                    raise
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt, e))
+
+    def _create_chat(self, **kwargs):
+        kwargs.setdefault("timeout", self.chat_timeout)
+        kwargs["model"] = resolve_chat_model(kwargs["model"])
+        return self._call(self.chat_raw.chat.completions.create, estimate_chat_tokens(kwargs),
+                          rate_limited=self.chat_rate_limited, **kwargs)
+
+    def _create_transcription(self, **kwargs):
+        kwargs.setdefault("timeout", self.transcription_timeout)
+        create = self.raw.audio.transcriptions.create
+        # Nur (Dateiname, Bytes)-Tupel lassen sich gefahrlos zweimal senden, Datei-Objekte nicht
+        if not self.hedge_after or not isinstance(kwargs.get("file"), tuple):
+            return self._call(create, **kwargs)
+
+        first = _hedge_pool.submit(self._call, create, **kwargs)
+        done, _ = wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+        second = _hedge_pool.submit(self._call, create, **kwargs)
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        if winner.exception() is not None:
+            return (second if winner is first else first).result()
+        return winner.result()
+
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key=None):
+    """Prozessweit geteilter `ResilientOpenAI` pro API-Key, über Sessions und Reruns hinweg."""
+    cache_key = hashlib.sha256((api_key or os.environ.get("OPENAI_API_KEY", "")).encode("utf-8")).hexdigest()
+    with _clients_lock:
+        client = _clients.get(cache_key)
+        if client is None:
+            client = _clients[cache_key] = ResilientOpenAI(api_key=api_key)
+        _clients.move_to_end(cache_key)
+        while len(_clients) > MAX_CACHED_CLIENTS:
+            _clients.popitem(last=False)
+        return client
+
+
+def make_async_client(api_key=None):
+    # Für die asyncio-Pipeline: das SDK wiederholt 429/5xx selbst mit Backoff und Jitter.
+    # Mit ARZTBRIEF_LLM_BASE_URL zeigt der Client auf den lokalen Endpunkt; die Pipeline
+    # transkribiert dann über ein Transkriptions-Backend statt über diesen Client.
+    if LLM_BASE_URL:
+        return openai.AsyncOpenAI(api_key=LLM_API_KEY, base_url=LLM_BASE_URL, max_retries=5,
+                                  timeout=openai.Timeout(120.0, connect=10.0))
+    return openai.AsyncOpenAI(api_key=api_key, max_retries=5, timeout=openai.Timeout(120.0, connect=10.0))
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import partial
+
+
+class PdfCache:
+    """In-Memory-LRU für fertige PDF-Dateien, begrenzt nach Anzahl und Gesamtgrösse.
+
+    Schlüssel ist der SHA-256 über Brieftext, Layout und Template-Version. Das PDF
+    wird erst beim Klick auf "PDF herunterladen" gerendert (`get_or_render` als
+    `data`-Callable von `st.download_button`); ein erneuter Download desselben,
+    unveränderten Briefs kommt aus dem Cache.
+    """
+
+    def __init__(self, max_entries=32, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text, layout="standard", template_version=None):
+        payload = json.dumps([text, layout, template_version], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            pdf_bytes = self._memory.get(key)
+            if pdf_bytes is not None:
+                self._memory.move_to_end(key)
+            return pdf_bytes
+
+    def put(self, key, pdf_bytes):
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._memory[key] = pdf_bytes
+            self._size += len(pdf_bytes)
+            while len(self._memory) > self.max_entries or (self._size > self.max_bytes and len(self._memory) > 1):
+                _, evicted = self._memory.popitem(last=False)
+                self._size -= len(evicted)
+
+    def get_or_render(self, key, render):
+        """`render()` liefert einen BytesIO-Puffer oder Bytes; zurück kommen immer Bytes."""
+        pdf_bytes = self.get(key)
+        if pdf_bytes is None:
+            result = render()
+            pdf_bytes = result.getvalue() if hasattr(result, "getvalue") else result
+            self.put(key, pdf_bytes)
+        return pdf_bytes
+
+    def download_data(self, key, render, *args, **kwargs):
+        # Für st.download_button(data=...): wird erst beim Klick aufgerufen, Argumente sind bereits gebunden
+        return partial(self.get_or_render, key, partial(render, *args, **kwargs))
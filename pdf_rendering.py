@@ -0,0 +1,298 @@
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+from functools import lru_cache
+from io import BytesIO
+
+from reportlab.lib.enums import TA_RIGHT
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfdoc import PDFImageXObject
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import Flowable, Image, Paragraph, Spacer
+
+from letter_sections import as_letter
+
+# Einmal pro Prozess vorbereitete PDF-Bausteine: Stylesheet, Logo und Briefköpfe.
+# reportlab dekodiert, komprimiert und ASCII85-kodiert ein PNG bei jedem doc.build()
+# erneut (reines Python, ~20 ms für logo.png); hier geschieht das nur beim ersten Mal.
+# Das Wiederverwenden greift auf interne reportlab-Attribute zu (getestet mit der in
+# requirements.txt festgelegten Version). Fehlen sie, wird wie bisher über
+# platypus.Image bzw. direktes Zeichnen gerendert, nur ohne Zwischenspeicherung.
+
+
+@lru_cache(maxsize=None)
+def canvas_internals_available():
+    """Prüft einmal, ob die genutzten internen Canvas-/Dokument-Attribute vorhanden sind."""
+    try:
+        canv = Canvas(BytesIO())
+        doc = canv._doc
+        return (
+            isinstance(canv._code, list)
+            and isinstance(canv._formsinuse, list)
+            and callable(canv._setXObjects)
+            and callable(canv._absRect)
+            and isinstance(doc.idToObject, dict)
+            and isinstance(doc.fontMapping, dict)
+            and all(callable(getattr(doc, name)) for name in ("getXObjectName", "Reference", "addForm",
+                                                               "getInternalFontName"))
+        )
+    except AttributeError:
+        return False
+
+
+@lru_cache(maxsize=None)
+def get_styles():
+    """Geteiltes Stylesheet; Styles werden beim Rendern nur gelesen, nie verändert."""
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name="Right", parent=styles["Normal"], alignment=TA_RIGHT))
+    return styles
+
+
+class PreparedImage:
+    """Fertig kodiertes Bild-XObject (inkl. Alpha-Maske), das in jedes Dokument kopiert wird."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        name = "Img" + hashlib.sha1(data).hexdigest()[:16]
+        self.xobject = PDFImageXObject(name, ImageReader(path), mask="auto")
+        self.name = name
+
+    def register(self, canv):
+        # Eigene Kopie pro Dokument: reportlab vermerkt beim Registrieren den Namen am Objekt
+        doc = canv._doc
+        reg_name = doc.getXObjectName(self.name)
+        if reg_name not in doc.idToObject:
+            image = copy.copy(self.xobject)
+            smask = image.__dict__.pop("_smask", None)
+            canv._setXObjects(image)
+            doc.Reference(image, reg_name)
+            doc.addForm(self.name, image)
+            if smask is not None:
+                smask = copy.copy(smask)
+                canv._setXObjects(smask)
+                image.smask = doc.Reference(smask, doc.getXObjectName(smask.name))
+        return reg_name
+
+
+class CachedImage(Flowable):
+    """Wie `reportlab.platypus.Image`, aber mit einem vorab kodierten `PreparedImage`."""
+
+    def __init__(self, image, width, height):
+        super().__init__()
+        self.image = image
+        self.drawWidth = width
+        self.drawHeight = height
+
+    def wrap(self, availWidth, availHeight):
+        return self.drawWidth, self.drawHeight
+
+    def draw(self):
+        canv = self.canv
+        reg_name = self.image.register(canv)
+        canv.saveState()
+        canv.scale(self.drawWidth, self.drawHeight)
+        canv._code.append(f"/{reg_name} Do")
+        canv.restoreState()
+        canv._formsinuse.append(self.image.name)
+
+
+_images_lock = threading.Lock()
+
+
+@lru_cache(maxsize=16)
+def _prepare_image(path, mtime):
+    return PreparedImage(path)
+
+
+def prepared_image(path):
+    """Bild pro Pfad und Änderungszeit nur einmal laden; wirft OSError, wenn es fehlt."""
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    with _images_lock:
+        return _prepare_image(path, mtime)
+
+
+def logo_version(path):
+    """Inhalts-Hash des Logos für Cache-Schlüssel; None, wenn die Datei fehlt."""
+    try:
+        return prepared_image(path).name
+    except OSError:
+        return None
+
+
+def logo_flowable(path, width, height, h_align="CENTER"):
+    if canvas_internals_available():
+        logo = CachedImage(prepared_image(path), width, height)
+    else:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        logo = Image(path, width=width, height=height)
+    logo.hAlign = h_align
+    return logo
+
+
+def section_flowables(report, heading_format="<b>{}:</b>"):
+    """Absätze für den Brieftext (str oder `Letter`): Einleitung, je Abschnitt Titel und Inhalt, Grussformel."""
+    styles = get_styles()
+    letter = as_letter(report)
+    elements = []
+    if letter.preamble:
+        elements.append(Paragraph(letter.preamble.replace("\n", "<br/>"), styles["BodyText"]))
+        elements.append(Spacer(1, 12))
+    for section in letter.sections:
+        elements.append(Paragraph(heading_format.format(section.title), styles["Heading4"]))
+        if section.content:
+            elements.append(Paragraph(section.content.replace("\n", "<br/>"), styles["BodyText"]))
+        elements.append(Spacer(1, 12))
+    if letter.closing:
+        elements.append(Paragraph(letter.closing.replace("\n", "<br/>"), styles["BodyText"]))
+    return elements
+
+
+LETTERHEADS_PATH = os.environ.get("ARZTBRIEF_LETTERHEADS", "letterheads.json")
+
+FONT_SELECT_PATTERN = re.compile(r"(/F\d+)(?= [\d.]+ Tf)")
+
+
+class _RecordingCanvas(Canvas):
+    # Link-Flächen sind Annotationen und nicht Teil des Seiteninhalts; sie werden separat gemerkt
+    def linkURL(self, url, rect, relative=0, **kw):
+        self.links.append((url, self._absRect(rect, relative)))
+
+
+class Letterhead:
+    """Briefkopf einer Klinik aus letterheads.json.
+
+    Logo und Adressblock werden einmal gesetzt und als fertige PDF-Operatoren
+    gespeichert; `stamp` kopiert sie auf die erste Seite jedes Briefs (als
+    `onFirstPage`-Callback). Pro Brief fällt so nur noch der Brieftext an.
+    Die Maße entsprechen einem `SimpleDocTemplate` mit Standardrändern.
+    Ohne die nötigen reportlab-Interna zeichnet `stamp` den Briefkopf jedes Mal neu.
+    """
+
+    def __init__(self, key, name, lines, logo=None, logo_size=(140, 25), pagesize=A4, top_margin=50,
+                 side_margin=72, padding=6):
+        self.key = key
+        self.name = name
+        self.lines = list(lines)
+        self.pagesize = pagesize
+        self.top_margin = top_margin
+        self.logo_path = logo
+        self._cached = canvas_internals_available()
+        # Ändert sich Text oder Logo, ändert sich die Version (z. B. für PDF-Caches)
+        digest = hashlib.sha256(json.dumps([key, name, lines, logo_size], ensure_ascii=False).encode("utf-8"))
+        if logo:
+            self.logo = prepared_image(logo) if self._cached else None
+            with open(logo, "rb") as f:
+                digest.update(hashlib.sha1(f.read()).digest())
+        else:
+            self.logo = None
+        self.version = digest.hexdigest()[:16]
+
+        page_width, page_height = pagesize
+        self._left = side_margin + padding
+        self._right = page_width - side_margin - padding
+        y = page_height - top_margin - padding
+        self.logo_box = None
+        if logo:
+            logo_width, logo_height = logo_size
+            y -= logo_height
+            self.logo_box = (self._right - logo_width, y, logo_width, logo_height)
+            y -= 6
+        _, block_height = self._block().wrap(self._right - self._left, page_height)
+        y -= block_height
+        self._block_y = y
+        self.height = page_height - top_margin - padding - y + 20
+
+        self.operators = None
+        if self._cached:
+            canv = _RecordingCanvas(BytesIO(), pagesize=pagesize)
+            canv.links = []
+            start = len(canv._code)
+            self._draw_block(canv)
+            self.operators = "\n".join(canv._code[start:])
+            self.fonts = dict(canv._doc.fontMapping)
+            self.links = canv.links
+
+    def _block(self):
+        return Paragraph("<br/>".join(self.lines), get_styles()["Right"])
+
+    def _draw_block(self, canv):
+        # Pro Aufruf ein eigener Paragraph: drawOn merkt sich den Canvas am Objekt
+        block = self._block()
+        block.wrap(self._right - self._left, self.pagesize[1])
+        block.drawOn(canv, self._left, self._block_y)
+
+    def spacer(self):
+        # Platzhalter im Textfluss, damit der Brieftext unterhalb des Briefkopfs beginnt
+        return Spacer(1, self.height)
+
+    def stamp(self, canv, doc=None):
+        if self.operators is None:
+            canv.saveState()
+            if self.logo_box is not None:
+                x, y, width, height = self.logo_box
+                canv.drawImage(self.logo_path, x, y, width, height, mask="auto")
+            self._draw_block(canv)
+            canv.restoreState()
+            return
+
+        operators = self.operators
+        renames = {old: canv._doc.getInternalFontName(ps) for ps, old in self.fonts.items()}
+        if any(old != new for old, new in renames.items()):
+            operators = FONT_SELECT_PATTERN.sub(lambda m: renames.get(m.group(1), m.group(1)), operators)
+
+        canv.saveState()
+        if self.logo_box is not None:
+            x, y, width, height = self.logo_box
+            reg_name = self.logo.register(canv)
+            canv._code.append(f"q {width} 0 0 {height} {x} {y} cm /{reg_name} Do Q")
+            canv._formsinuse.append(self.logo.name)
+        canv._code.append(operators)
+        canv.restoreState()
+        for url, rect in self.links:
+            canv.linkURL(url, rect)
+
+
+_letterheads_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4)
+def _load_letterheads(path, mtime):
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    base = os.path.dirname(path)
+    letterheads = {}
+    for key, entry in config.items():
+        logo = entry.get("logo")
+        letterheads[key] = Letterhead(
+            key,
+            entry["name"],
+            entry["lines"],
+            logo=os.path.join(base, logo) if logo else None,
+            logo_size=tuple(entry.get("logo_size", (140, 25))),
+        )
+    return letterheads
+
+
+def load_letterheads(path=None):
+    """Alle Briefköpfe (Schlüssel → Letterhead); neu geladen, sobald sich die Datei ändert."""
+    path = os.path.abspath(path or LETTERHEADS_PATH)
+    if not os.path.exists(path):
+        return {}
+    mtime = os.stat(path).st_mtime_ns
+    with _letterheads_lock:
+        return _load_letterheads(path, mtime)
+
+
+def clear_asset_cache():
+    # Für Kaltstart-Messungen im Benchmark
+    get_styles.cache_clear()
+    _prepare_image.cache_clear()
+    _load_letterheads.cache_clear()
@@ -0,0 +1,387 @@
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RECORDING_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+START_PATH = re.compile(r"^/recordings/([^/]+)/start$")
+CHUNK_PATH = re.compile(r"^/recordings/([^/]+)/chunks/(\d+)$")
+FINISH_PATH = re.compile(r"^/recordings/([^/]+)/finish$")
+TOKEN_HEADER = "X-Recording-Token"
+
+
+class RecordingStore:
+    """Nimmt Browser-Aufnahmen stückweise entgegen, solange noch aufgenommen wird.
+
+    Aufnahme-ID und Token werden serverseitig vergeben (`issue`) und mit dem
+    Recorder ausgeliefert; Uploads ohne passendes Token werden abgewiesen. Das
+    Token ist eine HMAC-Signatur der ID, `issue` belegt also nichts: Erst `start`
+    beim Drücken von "Aufnahme starten" legt die Aufnahme an. Neben der Grösse je
+    Aufnahme sind Anzahl laufender Aufnahmen und Gesamtgrösse begrenzt. Die Chunks liegen einmal als Bytes im Speicher; beim Abholen werden
+    sie in Reihenfolge zusammengesetzt und aus dem Store entfernt.
+    """
+
+    def __init__(self, max_bytes_per_recording=300 * 1024 * 1024, ttl_seconds=3600, max_recordings=8,
+                 max_total_bytes=1024 * 1024 * 1024):
+        self.max_bytes_per_recording = max_bytes_per_recording
+        self.ttl_seconds = ttl_seconds
+        self.max_recordings = max_recordings
+        self.max_total_bytes = max_total_bytes
+        self._secret = secrets.token_bytes(32)
+        self._recordings = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """`listener(recording_id, finished)` wird nach jedem Chunk und beim Abschluss aufgerufen."""
+        self._listeners.append(listener)
+
+    def _notify(self, recording_id, finished):
+        for listener in self._listeners:
+            listener(recording_id, finished)
+
+    def issue(self):
+        """(Aufnahme-ID, Token) für den Recorder einer Sitzung; belegt noch keinen Platz im Store."""
+        recording_id = uuid.uuid4().hex
+        return recording_id, self._sign(recording_id)
+
+    def _sign(self, recording_id):
+        return hmac.new(self._secret, recording_id.encode("ascii"), hashlib.sha256).hexdigest()
+
+    def start(self, recording_id, token):
+        """Aufnahme beim Start des Recorders anlegen; wirft ValueError, wenn kein Platz frei ist."""
+        if not hmac.compare_digest(self._sign(recording_id), token or ""):
+            raise PermissionError("ungültiges Token")
+        with self._lock:
+            self._expire()
+            recording = self._recordings.get(recording_id)
+            if recording is not None:
+                if recording["finished"]:
+                    raise ValueError("Aufnahme ist bereits abgeschlossen")
+                return
+            if len(self._recordings) >= self.max_recordings:
+                raise ValueError("Zu viele laufende Aufnahmen, bitte später erneut versuchen")
+            self._recordings[recording_id] = {"chunks": {}, "size": 0, "finished": False, "updated": time.time()}
+
+    def _authorized(self, recording_id, token):
+        # Aufruf nur mit gehaltenem Lock
+        if not hmac.compare_digest(self._sign(recording_id), token or ""):
+            raise PermissionError("ungültiges Token")
+        recording = self._recordings.get(recording_id)
+        if recording is None:
+            raise KeyError(recording_id)
+        return recording
+
+    def _check_size(self, recording, seq, length):
+        # Ein erneut gesendeter Chunk ersetzt den alten, dessen Grösse wird wieder frei
+        replaced = len(recording["chunks"].get(seq, b""))
+        if recording["finished"]:
+            raise ValueError("Aufnahme ist bereits abgeschlossen")
+        if recording["size"] - replaced + length > self.max_bytes_per_recording:
+            raise ValueError("Aufnahme überschreitet die maximale Grösse")
+        if self._total_bytes - replaced + length > self.max_total_bytes:
+            raise ValueError("Speicher für Aufnahmen ist erschöpft")
+        return replaced
+
+    def check_upload(self, recording_id, token, seq, length):
+        """Vor dem Lesen des Bodys: Token und angekündigte Grösse prüfen."""
+        with self._lock:
+            self._expire()
+            self._check_size(self._authorized(recording_id, token), seq, length)
+
+    def append(self, recording_id, token, seq, data):
+        with self._lock:
+            self._expire()
+            recording = self._authorized(recording_id, token)
+            replaced = self._check_size(recording, seq, len(data))
+            recording["chunks"][seq] = data
+            recording["size"] += len(data) - replaced
+            self._total_bytes += len(data) - replaced
+            recording["updated"] = time.time()
+        self._notify(recording_id, False)
+
+    def finish(self, recording_id, token):
+        with self._lock:
+            self._authorized(recording_id, token)["finished"] = True
+        self._notify(recording_id, True)
+
+    def is_finished(self, recording_id):
+        with self._lock:
+            recording = self._recordings.get(recording_id)
+            return bool(recording and recording["finished"])
+
+    def snapshot(self, recording_id, start_seq=0):
+        """Lückenlos empfangene Bytes ab Chunk `start_seq`, ohne die Aufnahme zu entfernen.
+
+        Liefert (Bytes, nächste noch fehlende Chunk-Nummer) oder None für unbekannte Aufnahmen.
+        """
+        with self._lock:
+            recording = self._recordings.get(recording_id)
+            if recording is None:
+                return None
+            chunks = recording["chunks"]
+            parts = []
+            seq = start_seq
+            while seq in chunks:
+                parts.append(chunks[seq])
+                seq += 1
+        return b"".join(parts), seq
+
+    def pop(self, recording_id):
+        with self._lock:
+            recording = self._recordings.pop(recording_id, None)
+            if recording is not None:
+                self._total_bytes -= recording["size"]
+        if recording is None:
+            return None
+        return b"".join(recording["chunks"][seq] for seq in sorted(recording["chunks"]))
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        for recording_id in [r for r, rec in self._recordings.items() if rec["updated"] < cutoff]:
+            self._total_bytes -= self._recordings.pop(recording_id)["size"]
+
+
+def make_handler(store, allowed_origins=()):
+    allowed_origins = frozenset(allowed_origins)
+
+    class RecordingUploadHandler(BaseHTTPRequestHandler):
+        def _send(self, status, payload=None):
+            body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+            self.send_response(status)
+            # CORS nur für die Streamlit-Origin(s), nicht für beliebige Seiten
+            origin = self.headers.get("Origin")
+            if origin in allowed_origins:
+                self.send_header("Access-Control-Allow-Origin", origin)
+                self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
+                self.send_header("Access-Control-Allow-Headers", f"Content-Type, {TOKEN_HEADER}")
+                self.send_header("Vary", "Origin")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if status >= 400:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_OPTIONS(self):
+            self._send(204)
+
+        def do_POST(self):
+            start_match = START_PATH.match(self.path)
+            chunk_match = CHUNK_PATH.match(self.path)
+            finish_match = FINISH_PATH.match(self.path)
+            match = start_match or chunk_match or finish_match
+            if not match or not RECORDING_ID_PATTERN.match(match.group(1)):
+                self._send(404, {"error": "unbekannter Pfad"})
+                return
+
+            recording_id = match.group(1)
+            token = self.headers.get(TOKEN_HEADER)
+            try:
+                if start_match:
+                    try:
+                        store.start(recording_id, token)
+                    except ValueError as e:
+                        # Kein Platz frei: vorübergehend, nicht zu gross
+                        self._send(503, {"error": str(e)})
+                        return
+                elif chunk_match:
+                    seq = int(chunk_match.group(2))
+                    try:
+                        length = int(self.headers.get("Content-Length", ""))
+                    except ValueError:
+                        length = -1
+                    if length < 0:
+                        self._send(411, {"error": "Content-Length fehlt"})
+                        return
+                    # Grösse und Token prüfen, bevor der Body gelesen wird
+                    store.check_upload(recording_id, token, seq, length)
+                    store.append(recording_id, token, seq, self.rfile.read(length))
+                else:
+                    store.finish(recording_id, token)
+            except KeyError:
+                self._send(404, {"error": "unbekannte Aufnahme"})
+                return
+            except PermissionError as e:
+                self._send(403, {"error": str(e)})
+                return
+            except ValueError as e:
+                self._send(413, {"error": str(e)})
+                return
+            self._send(200, {"ok": True})
+
+        def log_message(self, format, *args):
+            pass
+
+    return RecordingUploadHandler
+
+
+def start_upload_server(store, host="127.0.0.1", port=8502, allowed_origins=()):
+    """Startet den Upload-Server; wirft OSError, wenn der Port belegt ist."""
+    server = ThreadingHTTPServer((host, port), make_handler(store, allowed_origins))
+    thread = threading.Thread(target=server.serve_forever, name="recording-upload", daemon=True)
+    thread.start()
+    return server
+
+
+def forwarded_url(port):
+    """https-Adresse, unter der GitHub Codespaces einen Port weiterleitet; sonst None."""
+    name = os.environ.get("CODESPACE_NAME")
+    domain = os.environ.get("GITHUB_CODESPACES_PORT_FORWARDING_DOMAIN")
+    if name and domain:
+        return f"https://{name}-{port}.{domain}"
+    return None
+
+
+def upload_url(upload_port):
+    """Adresse des Upload-Servers für den Browser.
+
+    ARZTBRIEF_UPLOAD_URL hat Vorrang (z. B. hinter einem Reverse Proxy mit https),
+    danach die Codespaces-Weiterleitung des Ports. None: der Recorder nimmt den
+    Host der Streamlit-Seite mit `upload_port`; das geht nur ohne https, weil der
+    Upload-Server selbst nur http spricht.
+    """
+    return os.environ.get("ARZTBRIEF_UPLOAD_URL") or forwarded_url(upload_port)
+
+
+def upload_origins(streamlit_port):
+    """Origins der Streamlit-Seite, die hochladen dürfen (kommagetrennt in ARZTBRIEF_UPLOAD_ORIGINS)."""
+    configured = os.environ.get("ARZTBRIEF_UPLOAD_ORIGINS")
+    if configured:
+        return [origin.strip() for origin in configured.split(",") if origin.strip()]
+    origins = [f"http://localhost:{streamlit_port}", f"http://127.0.0.1:{streamlit_port}"]
+    if forwarded_url(streamlit_port):
+        origins.append(forwarded_url(streamlit_port))
+    return origins
+
+
+def recorder_html(recording_id, token, upload_url=None, upload_port=8502, timeslice_ms=1000):
+    """HTML/JS-Recorder, der jeden MediaRecorder-Chunk sofort binär hochlädt.
+
+    `recording_id` und `token` stammen aus `RecordingStore.issue`. Nach dem Stoppen
+    wird nur die Aufnahme-ID an Streamlit gemeldet, nicht die Audiodaten.
+    """
+    upload_base = json.dumps(upload_url) if upload_url else (
+        f"window.parent.location.protocol + '//' + window.parent.location.hostname + ':{upload_port}'"
+    )
+    return """
+<script>
+const uploadBase = %(upload_base)s;
+const recordingId = %(recording_id)s;
+const uploadHeaders = { %(token_header)s: %(token)s };
+let mediaRecorder;
+let seq = 0;
+let pendingUploads = [];
+function setStatus(text) {
+    document.getElementById("status").innerText = text;
+}
+async function post(url, body) {
+    const response = await fetch(url, { method: "POST", headers: uploadHeaders, body: body });
+    if (!response.ok) {
+        let message = `HTTP ${response.status}`;
+        try { message = (await response.json()).error || message; } catch (e) {}
+        throw new Error(message);
+    }
+}
+function uploadChunk(data) {
+    const upload = post(`${uploadBase}/recordings/${recordingId}/chunks/${seq++}`, data);
+    // Fehler sofort anzeigen; die Aufnahme wird trotzdem beim Stoppen als fehlgeschlagen gemeldet
+    upload.catch(error => setStatus("❌ Upload fehlgeschlagen: " + error.message));
+    pendingUploads.push(upload);
+}
+async function startRecording() {
+    if (mediaRecorder && mediaRecorder.state === "recording") {
+        return;
+    }
+    if (window.parent.location.protocol === "https:" && uploadBase.startsWith("http:")) {
+        // Der Browser blockiert den Upload als Mixed Content
+        setStatus("❌ Upload-Server nur per http erreichbar; ARZTBRIEF_UPLOAD_URL auf eine https-Adresse setzen.");
+        return;
+    }
+    let stream;
+    try {
+        stream = await navigator.mediaDevices.getUserMedia({ audio: true });
+    } catch (error) {
+        setStatus("❌ Mikrofon nicht verfügbar: " + error.message);
+        return;
+    }
+    try {
+        // Erst jetzt belegt die Aufnahme einen Platz auf dem Server
+        await post(`${uploadBase}/recordings/${recordingId}/start`, null);
+        // Safari kann kein WebM aufnehmen und wirft bei fester mimeType; dann Standardformat (MP4)
+        const options = MediaRecorder.isTypeSupported && MediaRecorder.isTypeSupported("audio/webm")
+            ? { mimeType: "audio/webm" } : {};
+        mediaRecorder = new MediaRecorder(stream, options);
+    } catch (error) {
+        stream.getTracks().forEach(track => track.stop());
+        setStatus("❌ Aufnahme kann nicht starten: " + error.message);
+        return;
+    }
+    seq = 0;
+    pendingUploads = [];
+    mediaRecorder.ondataavailable = event => {
+        if (event.data.size > 0) {
+            uploadChunk(event.data);
+        }
+    };
+    mediaRecorder.onstop = async () => {
+        stream.getTracks().forEach(track => track.stop());
+        setStatus("⏳ Letzte Audiodaten werden übertragen...");
+        try {
+            await Promise.all(pendingUploads);
+            await post(`${uploadBase}/recordings/${recordingId}/finish`, null);
+        } catch (error) {
+            setStatus("❌ Aufnahme konnte nicht übertragen werden: " + error.message);
+            return;
+        }
+        setStatus("✅ Aufnahme abgeschlossen.");
+        window.parent.postMessage({ type: 'FROM_IFRAME', recording_id: recordingId }, '*');
+    };
+    mediaRecorder.start(%(timeslice_ms)d);
+    setStatus("🔴 Aufnahme läuft...");
+}
+function stopRecording() {
+    if (mediaRecorder && mediaRecorder.state === "recording") {
+        mediaRecorder.stop();
+    }
+}
+</script>
+<div>
+    <button onclick="startRecording()">🎙️ Aufnahme starten</button>
+    <button onclick="stopRecording()">⏹️ Aufnahme stoppen</button>
+    <p id="status" style="font-weight:bold; color:darkred;"></p>
+</div>
+""" % {
+        "upload_base": upload_base,
+        "recording_id": json.dumps(recording_id),
+        "token_header": json.dumps(TOKEN_HEADER),
+        "token": json.dumps(token),
+        "timeslice_ms": timeslice_ms,
+    }
+
+
+# JS-Listener für streamlit_js_eval: wartet auf die Aufnahme-ID aus dem Recorder-iframe.
+# Der Listener des vorherigen Reruns wird entfernt, damit sich keine Listener anhäufen.
+RECORDING_ID_LISTENER_JS = """
+await new Promise(resolve => {
+  if (window.arztbriefRecordingListener) {
+    window.removeEventListener('message', window.arztbriefRecordingListener);
+  }
+  window.arztbriefRecordingListener = (event) => {
+    if (event.data && event.data.recording_id) {
+      window.removeEventListener('message', window.arztbriefRecordingListener);
+      window.arztbriefRecordingListener = null;
+      resolve(event.data.recording_id);
+    }
+  };
+  window.addEventListener('message', window.arztbriefRecordingListener);
+})
+"""
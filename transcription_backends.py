@@ -0,0 +1,94 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from audio_processing import decode_for_speech, transcribe_audio_bytes, whisper_transcriber
+from metrics import span
+
+# Ein Backend bietet:
+#   model_id                  – geht in den Transkript-Cache-Schlüssel ein
+#   transcribe(file)          – ein (Dateiname, Bytes)-Tupel → Text (z. B. für Live-Abschnitte)
+#   transcribe_bytes(audio)   – komplette Aufnahme → Text, inkl. eventueller Aufteilung
+
+
+class OpenAIWhisperBackend:
+    def __init__(self, client, model="whisper-1", language="de", max_workers=4):
+        self.client = client
+        self.model = model
+        self.model_id = model
+        self.language = language
+        self.max_workers = max_workers
+
+    def transcribe(self, file):
+        return whisper_transcriber(self.client, model=self.model, language=self.language)(file)
+
+    def transcribe_bytes(self, audio_bytes):
+        with span("transcription", input_size=len(audio_bytes), model=self.model_id) as attrs:
+            text = transcribe_audio_bytes(self.client, audio_bytes, model=self.model, language=self.language,
+                                          max_workers=self.max_workers)
+            attrs["output_size"] = len(text)
+        return text
+
+
+class LocalWhisperBackend:
+    """faster-whisper (CTranslate2) auf der CPU, standardmässig int8-quantisiert.
+
+    Das Modell wird einmal pro Prozess geladen (`get_local_backend`) und von allen
+    Sessions geteilt; ein Thread-Pool mit `max_workers` Plätzen begrenzt, wie viele
+    Aufnahmen gleichzeitig dekodiert werden. Keine Upload-Grenze, daher kein Aufteilen.
+    """
+
+    def __init__(self, model_size="base", compute_type="int8", language="de", max_workers=2, cpu_threads=0,
+                 beam_size=1):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise RuntimeError("Lokale Transkription benötigt das Paket 'faster-whisper'.") from e
+
+        self.model_id = f"faster-whisper-{model_size}-{compute_type}"
+        self.language = language
+        self.beam_size = beam_size
+        self.model = WhisperModel(model_size, device="cpu", compute_type=compute_type,
+                                  cpu_threads=cpu_threads, num_workers=max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="local-whisper")
+
+    def _run(self, audio_bytes):
+        import numpy as np
+
+        audio = decode_for_speech(audio_bytes)
+        samples = np.frombuffer(audio.raw_data, dtype=np.int16).astype(np.float32) / 32768.0
+        segments, _ = self.model.transcribe(samples, language=self.language, beam_size=self.beam_size,
+                                            vad_filter=True)
+        return " ".join(segment.text.strip() for segment in segments).strip()
+
+    def transcribe(self, file):
+        return self.transcribe_bytes(file[1])
+
+    def transcribe_bytes(self, audio_bytes):
+        with span("transcription", input_size=len(audio_bytes), model=self.model_id) as attrs:
+            text = self._pool.submit(self._run, audio_bytes).result()
+            attrs["output_size"] = len(text)
+        return text
+
+
+_local_backends = {}
+_local_backends_lock = threading.Lock()
+
+
+def get_local_backend(language="de"):
+    model_size = os.environ.get("ARZTBRIEF_LOCAL_WHISPER_MODEL", "base")
+    compute_type = os.environ.get("ARZTBRIEF_LOCAL_WHISPER_COMPUTE_TYPE", "int8")
+    max_workers = int(os.environ.get("ARZTBRIEF_LOCAL_WHISPER_WORKERS", "2"))
+    key = (model_size, compute_type, language, max_workers)
+    with _local_backends_lock:
+        if key not in _local_backends:
+            _local_backends[key] = LocalWhisperBackend(model_size, compute_type=compute_type, language=language,
+                                                       max_workers=max_workers)
+        return _local_backends[key]
+
+
+def get_transcription_backend(client=None, language="de"):
+    """Backend laut ARZTBRIEF_TRANSCRIPTION_BACKEND: "openai" (Standard) oder "local"."""
+    if os.environ.get("ARZTBRIEF_TRANSCRIPTION_BACKEND", "openai") == "local":
+        return get_local_backend(language)
+    return OpenAIWhisperBackend(client, language=language)
@@ -0,0 +1,28 @@
+import hashlib
+
+from disk_cache import DiskLruCache
+
+
+class TranscriptionCache(DiskLruCache):
+    """Transkript-Cache mit In-Memory-LRU und optionaler Ablage auf Disk.
+
+    Schlüssel ist der SHA-256 der Audiodaten zusammen mit Modell und Sprache,
+    damit ein erneuter Upload oder ein Streamlit-Rerun whisper-1 nicht erneut aufruft.
+    """
+
+    def __init__(self, max_entries=128, cache_dir=None, max_disk_bytes=50 * 1024 * 1024, ttl_seconds=None):
+        super().__init__(max_entries=max_entries, cache_dir=cache_dir, max_disk_bytes=max_disk_bytes,
+                         ttl_seconds=ttl_seconds)
+
+    @staticmethod
+    def make_key(audio_bytes, model="whisper-1", language="de"):
+        digest = hashlib.sha256(audio_bytes).hexdigest()
+        return f"{model}-{language}-{digest}"
+
+    def get_or_transcribe(self, audio_bytes, transcribe, model="whisper-1", language="de"):
+        key = self.make_key(audio_bytes, model=model, language=language)
+        text = self.get(key)
+        if text is None:
+            text = transcribe(audio_bytes)
+            self.put(key, text)
+        return text